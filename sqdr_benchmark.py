@@ -0,0 +1,292 @@
+#!/usr/bin/env python
+
+# times the stages of loading, fitting and saving raw squid data on
+# synthetic files (see sqdr_synthetic.py) of 10, 1000 and 20000 scans.
+# Results are saved as JSON; compared with a baseline saved earlier, stages
+# more than --threshold slower than the baseline are reported and the exit
+# code is 1. The RsoModel kernels of --backend are first checked against
+# rso_response and rso_jacobian, the exit code is also 1 if they differ.
+# Startup (import and time to first plot) is timed in a new interpreter
+
+import io
+import os
+import sys
+import json
+import time
+import argparse
+import platform
+import tempfile
+import subprocess
+import numpy as np
+import matplotlib
+matplotlib.use('Agg')
+
+import sqdr_windows_Jay as sqdr
+import sqdr_synthetic
+
+default_sizes = [10, 1000, 20000]
+# stages fitting scans one at a time are timed on at most this many scans
+# and scaled up to all of them
+per_scan_limit = 500
+# version of the results format
+results_version = 2
+# largest relative difference of the model kernels from rso_response
+parity_tolerance = 1e-10
+# model kernel passes timed by stage_model_kernels, about the iterations of
+# a batched fit
+kernel_passes = 10
+
+# data and fitted Squid of one synthetic file, shared by the stages
+class Bench_file:
+    def __init__(self, fname, jobs = 1):
+        self.fname = fname
+        self.jobs = jobs
+        self.data = sqdr.read_sqd(fname)
+        self.squid = sqdr.Squid(fname, jobs = jobs, warm_start = False, cache = False,
+                plots = False)
+        self.squid.figures(1)
+        step = max(1, len(self.squid.scans) // per_scan_limit)
+        self.sample = self.squid.scans[::step][:per_scan_limit]
+        self.scale = len(self.squid.scans) / float(len(self.sample))
+        # every scan padded into one batch at its fit, for the model kernels
+        scans = self.squid.scans
+        pos, self.vol, mask, index_array = sqdr.pad_scans([s.position for s in scans],
+                [s.voltage for s in scans])
+        self.popt = np.array([s.best_popt for s in scans])
+        self.model = sqdr.RsoModel(pos, index_array, mask)
+        self.parity = model_parity(self)
+
+# largest difference of the RsoModel kernels from rso_response and
+# rso_jacobian on the sampled scans at their fits, relative to the largest
+# value of each, for single scans and the padded batch
+def model_parity(bench):
+    worst = 0.
+    res, chi2, jac = bench.model.residual_jacobian(bench.popt, bench.vol)
+    for scan in bench.sample:
+        i = scan.row
+        n = len(scan.position)
+        popt = bench.popt[i]
+        voltage = sqdr.rso_response(scan.position, *popt)
+        jacobian = sqdr.rso_jacobian(scan.position, *popt)
+        model = sqdr.RsoModel(scan.position)
+        # copied, the next call may overwrite the buffers
+        for value, expected in ((model.evaluate(popt).copy(), voltage),
+                (model.jacobian(popt).copy(), jacobian),
+                (res[i, :n], voltage - scan.voltage),
+                (jac[i, :n], jacobian)):
+            scale = np.abs(expected).max(axis = 0)
+            worst = max(worst, (np.abs(value - expected) / scale).max())
+    return float(worst)
+
+def stage_read_sqd(bench):
+    sqdr.read_sqd(bench.fname)
+
+# splitting into scans, as done when loading: into a ScanTable
+def stage_split_sqd(bench):
+    sqdr.ScanTable(*sqdr.index_sqd(bench.data))
+
+def stage_fit(bench):
+    for scan in bench.sample:
+        scan.fit(center = True, print_new_fit = False)
+
+def stage_original_fit(bench):
+    for scan in bench.sample:
+        scan.original_fit(center = True)
+
+def stage_refit_centers(bench):
+    bench.squid.refit_centers()
+
+def stage_plot_dependence(bench):
+    bench.squid.plot_dependence()
+    bench.squid.tdf.canvas.draw()
+
+def stage_dump_fit(bench):
+    sqdr.dump_fit(bench.squid, io.StringIO())
+
+# startup in a new python: importing sqdr_windows_Jay, and with a file
+# name also loading the file like the program does (fitting it and making
+# its figures) and drawing the dependence plot
+startup_code = '''
+import sys, matplotlib
+matplotlib.use('Agg')
+import sqdr_windows_Jay as sqdr
+if len(sys.argv) > 1:
+    sqdr.sqd_sidecar = False
+    sqdr.model_backend = sys.argv[3]
+    squid = sqdr.Squid(sys.argv[1], jobs = int(sys.argv[2]), warm_start = False,
+            cache = False)
+    squid.tdf.canvas.draw()
+'''
+
+def startup(*args):
+    directory = os.path.dirname(os.path.abspath(sqdr.__file__))
+    with open(os.devnull, 'w') as devnull:
+        subprocess.check_call([sys.executable, '-c', startup_code] + list(args),
+                cwd = directory, stdout = devnull)
+
+def stage_import(bench):
+    startup()
+
+def stage_first_plot(bench):
+    startup(os.path.abspath(bench.fname), str(bench.jobs), sqdr.model_backend)
+
+# residuals, chi2 and jacobian of every scan at once
+def stage_model_kernels(bench):
+    for i in range(kernel_passes):
+        bench.model.residual_jacobian(bench.popt, bench.vol)
+
+# (name, function of a Bench_file, timed on bench.sample only)
+stages = [('import', stage_import, False),
+        ('first_plot', stage_first_plot, False),
+        ('read_sqd', stage_read_sqd, False),
+        ('split_sqd', stage_split_sqd, False),
+        ('fit', stage_fit, True),
+        ('original_fit', stage_original_fit, True),
+        ('refit_centers', stage_refit_centers, False),
+        ('plot_dependence', stage_plot_dependence, False),
+        ('dump_fit', stage_dump_fit, False),
+        ('model_kernels', stage_model_kernels, False)]
+
+# best time of repeat calls of func
+def best_time(func, repeat = 3):
+    best = np.inf
+    for i in range(repeat):
+        start = time.perf_counter()
+        func()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+# synthetic file of n scans in directory, written unless it already exists
+def synthetic_file(directory, n, points = 64, seed = 0, **kwargs):
+    name = 'synthetic_{}x{}_{}'.format(n, points, seed)
+    for key in sorted(kwargs):
+        name += '_{}{}'.format(key, kwargs[key])
+    fname = os.path.join(directory, name + '.sqd')
+    if not os.path.exists(fname):
+        tmp = fname + '.{}.tmp'.format(os.getpid())
+        sqdr_synthetic.write_sqd(tmp, n, points, seed, **kwargs)
+        os.replace(tmp, fname)
+    return fname
+
+# times of every stage for every size, as {size: {stage: seconds}}
+# parity, a dict, gets the model_parity of every size
+def run(sizes, directory, points = 64, repeat = 3, jobs = 1, names = None, parity = None,
+        **kwargs):
+    # parsing is timed, not loading the saved arrays
+    sqdr.sqd_sidecar = False
+    results = {}
+    for n in sizes:
+        fname = synthetic_file(directory, n, points, **kwargs)
+        bench = Bench_file(fname, jobs)
+        print("{:>6} scans {:>16}: {:9.2e}".format(n, 'model parity', bench.parity))
+        if parity is not None:
+            parity[str(n)] = bench.parity
+        times = {}
+        for name, func, per_scan in stages:
+            if names and name not in names:
+                continue
+            seconds = best_time(lambda : func(bench), repeat)
+            if per_scan:
+                seconds *= bench.scale
+            times[name] = seconds
+            print("{:>6} scans {:>16}: {:9.4f} s".format(n, name, seconds))
+        matplotlib.pyplot.close('all')
+        results[str(n)] = times
+    return results
+
+def environment():
+    try:
+        import numba
+        numba_version = numba.__version__
+    except ImportError:
+        numba_version = None
+    return dict(python = platform.python_version(), numpy = np.__version__,
+            matplotlib = matplotlib.__version__, machine = platform.machine(),
+            platform = platform.platform(), processor = platform.processor(),
+            numba = numba_version,
+            model_backend = 'numpy' if sqdr.rso_kernel() is None else 'numba')
+
+# stages more than threshold (fraction) slower than in baseline, ignoring
+# differences below min_time seconds; returns [(size, stage, baseline, time)]
+def compare(results, baseline, threshold = 0.25, min_time = 0.005):
+    slower = []
+    for size, times in sorted(results.items(), key = lambda x : int(x[0])):
+        old_times = baseline.get(size, {})
+        for name, seconds in times.items():
+            if name not in old_times:
+                continue
+            old = old_times[name]
+            if seconds > old * (1 + threshold) and seconds - old > min_time:
+                slower.append((int(size), name, old, seconds))
+    return slower
+
+def main(args):
+    directory = args.data_dir
+    if directory is None:
+        directory = os.path.join(tempfile.gettempdir(), 'sqdr_benchmark')
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    sqdr.model_backend = args.backend
+    parity = {}
+    results = run(args.sizes, directory, args.points, args.repeat, args.jobs, args.stage,
+            parity, noise = args.noise, drift = args.drift, jumps = args.jumps)
+    report = dict(version = results_version, environment = environment(),
+            points = args.points, jobs = args.jobs, per_scan_limit = per_scan_limit,
+            parity = parity, results = results)
+    if args.output is not None:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent = 2, sort_keys = True)
+    failed = [size for size in parity if parity[size] > parity_tolerance]
+    if failed:
+        print("Model kernels differ from rso_response by more than {:.0e} for {} scans".format(
+            parity_tolerance, ', '.join(failed)))
+        return 1
+    if args.baseline is None:
+        return 0
+    with open(args.baseline) as f:
+        baseline = json.load(f)
+    slower = compare(results, baseline['results'], args.threshold, args.min_time)
+    for size, name, old, seconds in slower:
+        print("{} scans {}: {:.4f} s -> {:.4f} s ({:+.0f}%)".format(size, name, old,
+            seconds, 100 * (seconds / old - 1)))
+    if slower:
+        print("{} stages slower than {} by more than {:.0f}%".format(len(slower),
+            args.baseline, 100 * args.threshold))
+        return 1
+    print("No stage slower than {} by more than {:.0f}%".format(args.baseline,
+        100 * args.threshold))
+    return 0
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--sizes", type = int, nargs = '+', default = default_sizes,
+            help = "Numbers of scans of the synthetic files (default 10 1000 20000)")
+    parser.add_argument("--points", type = int, default = 64,
+            help = "Points per scan (default 64)")
+    parser.add_argument("--noise", type = float, default = 0.02,
+            help = "Noise relative to the moment (default 0.02)")
+    parser.add_argument("--drift", type = float, default = 0.005,
+            help = "Voltage drift over a scan (default 0.005)")
+    parser.add_argument("--jumps", type = float, default = 0.,
+            help = "Fraction of scans with a flux jump (default 0)")
+    parser.add_argument("--stage", action = "append", default = None,
+            choices = [name for name, func, per_scan in stages],
+            help = "Only time this stage (may be repeated)")
+    parser.add_argument("--backend", default = 'auto', choices = ['auto', 'numba', 'numpy'],
+            help = "Kernels of the fit model (default auto: numba if installed)")
+    parser.add_argument("--repeat", type = int, default = 3,
+            help = "Best of this many runs of each stage (default 3)")
+    parser.add_argument("--jobs", type = int, default = 1,
+            help = "Number of worker processes used for fitting (default 1)")
+    parser.add_argument("--data-dir", default = None,
+            help = "Directory for the synthetic files (default in the temporary directory)")
+    parser.add_argument("--output", default = None,
+            help = "Save the results as JSON")
+    parser.add_argument("--baseline", default = None,
+            help = "JSON results to compare with; slower stages make the exit code 1")
+    parser.add_argument("--threshold", type = float, default = 0.25,
+            help = "Allowed slow down relative to the baseline (default 0.25)")
+    parser.add_argument("--min-time", type = float, default = 0.005,
+            help = "Ignore slow downs of less than this many seconds (default 0.005)")
+    args = parser.parse_args()
+    sys.exit(main(args))
@@ -0,0 +1,93 @@
+#!/usr/bin/env python
+
+# writes synthetic raw squid files in the format read by sqdr_windows_Jay:
+# a temperature sweep of a Curie paramagnet, every scan fitted exactly by
+# rso_response plus noise. With --live scans are appended one row at a time
+# like a running measurement, for trying out sqdr_windows_Jay.py --follow
+
+import time
+import argparse
+import numpy as np
+
+from sqdr_windows_Jay import rso_response, sqd_header_lines
+
+header = ('Comment,Time,Start Temperature (K),End Temperature (K),Field (Oe),'
+        'Position (cm),Long Voltage,Long Demeaned Voltage,Long Demeaned Fit,'
+        'Long Scaled Response\n')
+
+# raw squid rows of scan i of n, as lines of text. noise is relative to the
+# moment, drift is x2 (voltage drift over the scan) and jumps is the chance
+# of a flux jump of jump_size times the moment somewhere in the scan
+def scan_lines(i, n, points = 64, field = 1000., t_min = 2., t_max = 300.,
+        noise = 0.02, drift = 0.005, jumps = 0., jump_size = 0.2, rng = None,
+        start_time = 0.):
+    if rng is None:
+        rng = np.random.default_rng(i)
+    temperature = t_min + (t_max - t_min) * i / max(n - 1, 1)
+    position = np.linspace(0, 4, points)
+    # moment of a Curie-Weiss paramagnet, x4 = -center
+    x3 = field * 1e-3 / (temperature + 5.)
+    x4 = -2 + rng.normal(0, 0.05)
+    voltage = rso_response(position, 0.01, drift, x3, x4)
+    voltage += rng.normal(0, noise * abs(x3), points)
+    if jumps and rng.random() < jumps:
+        voltage[rng.integers(1, points):] += jump_size * abs(x3)
+    fit_voltage = rso_response(position, 0, 0, x3, x4)
+    # scaled response = 2 * raw voltage
+    raw = voltage / 2.
+    scan_time = start_time + 10. * i
+    return [',{:.6f},{:.4f},{:.4f},{:.1f},{:.5f},{:.8e},{:.8e},{:.8e},{:.8e}\n'.format(
+        scan_time, temperature, temperature + 0.1, field, position[k],
+        raw[k], raw[k], fit_voltage[k] / 2., voltage[k]) for k in range(points)]
+
+def write_header(f):
+    for i in range(sqd_header_lines):
+        f.write('[Header] synthetic squid data line {}\n'.format(i))
+    f.write(header)
+
+# whole file at once
+def write_sqd(fname, scans = 50, points = 64, seed = 0, **kwargs):
+    rng = np.random.default_rng(seed)
+    with open(fname, 'w') as f:
+        write_header(f)
+        for i in range(scans):
+            f.writelines(scan_lines(i, scans, points, rng = rng, **kwargs))
+
+# one row every interval/points seconds, so a scan takes interval seconds
+def write_sqd_live(fname, scans = 50, points = 64, seed = 0, interval = 1., **kwargs):
+    rng = np.random.default_rng(seed)
+    start_time = time.time()
+    with open(fname, 'w') as f:
+        write_header(f)
+        f.flush()
+        for i in range(scans):
+            for line in scan_lines(i, scans, points, rng = rng, start_time = start_time,
+                    **kwargs):
+                f.write(line)
+                f.flush()
+                time.sleep(interval / points)
+            print('Wrote scan {}/{}'.format(i + 1, scans))
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("FILE", help = "Raw squid data file to write")
+    parser.add_argument("--scans", type = int, default = 50,
+            help = "Number of scans (default 50)")
+    parser.add_argument("--points", type = int, default = 64,
+            help = "Points per scan (default 64)")
+    parser.add_argument("--seed", type = int, default = 0,
+            help = "Seed of the noise (default 0)")
+    parser.add_argument("--noise", type = float, default = 0.02,
+            help = "Noise relative to the moment (default 0.02)")
+    parser.add_argument("--drift", type = float, default = 0.005,
+            help = "Voltage drift over a scan (default 0.005)")
+    parser.add_argument("--jumps", type = float, default = 0.,
+            help = "Fraction of scans with a flux jump (default 0)")
+    parser.add_argument("--live", type = float, default = None, metavar = 'SECONDS',
+            help = "Append the file a row at a time, taking SECONDS per scan")
+    args = parser.parse_args()
+    options = dict(noise = args.noise, drift = args.drift, jumps = args.jumps)
+    if args.live is None:
+        write_sqd(args.FILE, args.scans, args.points, args.seed, **options)
+    else:
+        write_sqd_live(args.FILE, args.scans, args.points, args.seed, args.live, **options)
@@ -6,60 +6,267 @@ import numpy as np
 import os
 import argparse
 import time
+import hashlib
+import zlib
+import io
+import json
+import traceback
+import contextlib
+import functools
+import cProfile
+import multiprocessing
+import pstats
+from concurrent.futures import ProcessPoolExecutor, as_completed
 # python 2.7, 3.x compatible, maybe
 try:
-    import tkinter as tk
-    from tkinter import filedialog
-except:
-    import Tkinter as tk
-    import tkFileDialog as filedialog
+    import queue
+except ImportError:
+    import Queue as queue
 import matplotlib
-from matplotlib import pyplot, ticker
+from matplotlib import pyplot, ticker, transforms
+from matplotlib.collections import LineCollection
 plt = pyplot
-from scipy.optimize import curve_fit
-from IPython import embed
 import threading
 
+# Tk is imported by import_tk when a Window or file dialog is needed, and
+# scipy.optimize and IPython where they are used, so use without a display
+# (--batch, worker processes, the benchmark) never loads them
+tk = filedialog = ttk = None
+def import_tk():
+    global tk, filedialog, ttk
+    if tk is not None:
+        return
+    try:
+        import tkinter as tk
+        from tkinter import filedialog, ttk
+    except ImportError:
+        import Tkinter as tk
+        import tkFileDialog as filedialog
+        import ttk
+
 # factor to convert from scaled voltage x3 to EMU
 # may want to check this later
 squid_factor = 1.09589
 
-# limits for rso_response fitting
-x1_min = None
-x1_max = None
-x2_min = None
-x2_max = None
-x3_min = None
-x3_max = None
-x4_min = None
-x4_max = None
-
-def within_lims(x1, x2, x3, x4):
-    if x1_min is not None:
-        if x1 < x1_min:
-            return False
-    if x2_min is not None:
-        if x2 < x2_min:
-            return False
-    if x3_min is not None:
-        if x3 < x3_min:
-            return False
-    if x4_min is not None:
-        if x4 < x4_min:
-            return False
-    if x1_max is not None:
-        if x1 > x1_max:
-            return False
-    if x2_max is not None:
-        if x2 > x2_max:
-            return False
-    if x3_max is not None:
-        if x3 > x3_max:
-            return False
-    if x4_max is not None:
-        if x4 > x4_max:
-            return False
-    return True
+# rso_response model constants (cm)
+rso_R = 0.97
+rso_L = 1.519
+
+# on-disk cache of fit results, cleared of least recently used entries
+# when it grows beyond fit_cache_max_bytes
+fit_cache_dir = os.path.join(os.path.expanduser('~'), '.cache', 'sqdr_fits')
+fit_cache_max_bytes = 256 * 2**20
+# change when the fitting code changes results, invalidates all entries
+fit_cache_version = 3
+
+# how fit(center = True) looks for the sample center:
+# 'varpro' scans a dense grid of centers with the linear parameters solved
+# in closed form, 'multistart' runs full fits from multistart_centers
+center_search = 'varpro'
+# centers (cm, x4 = -center) tried by the separable center search
+varpro_centers = np.linspace(0.1, 4.1, 201)
+# starting centers (cm) of the multistart center search. Starts within
+# multistart_center_tol (cm) of a center an earlier start converged to are
+# skipped, and the search stops after multistart_patience starts in a row
+# that didn't improve chi2
+multistart_centers = np.linspace(0.1, 4.1, 9)
+multistart_center_tol = 0.1
+multistart_patience = 3
+
+# kernels of RsoModel: 'numba' compiles one fused pass over the points for
+# the residuals, chi2 and jacobian (numba must be installed), 'numpy' uses
+# in-place NumPy operations and 'auto' numba when it is installed
+model_backend = 'auto'
+
+# scans fitted at a time by the background fitting of lazy loading
+prefetch_chunk = 200
+
+# scans per block of Squid.refit_blocks; scans are only chained to their
+# neighbours within a block
+refit_block_size = 16
+
+# limits for rso_response fitting, None for no limit; a min equal to its max
+# fixes the parameter, a min above its max is a ValueError
+# force_center keeps x4 within 0.02 cm of the given value and force_sign
+# fixes the sign of x3 (magnetization); all become bounds of the fit
+class FitConstraints:
+    names = ['x1_min', 'x1_max', 'x2_min', 'x2_max',
+            'x3_min', 'x3_max', 'x4_min', 'x4_max']
+
+    def __init__(self, x1_min = None, x1_max = None, x2_min = None, x2_max = None,
+            x3_min = None, x3_max = None, x4_min = None, x4_max = None,
+            force_center = None, force_sign = 0):
+        self.x1_min, self.x1_max = x1_min, x1_max
+        self.x2_min, self.x2_max = x2_min, x2_max
+        self.x3_min, self.x3_max = x3_min, x3_max
+        self.x4_min, self.x4_max = x4_min, x4_max
+        self.force_center = force_center
+        self.force_sign = force_sign
+        self.bounds()
+
+    def __repr__(self):
+        return "FitConstraints({})".format(', '.join('{} = {}'.format(k, v)
+            for k, v in zip(self.names + ['force_center', 'force_sign'], self.key())))
+
+    # everything that changes a fit, for comparing and hashing
+    def key(self):
+        return tuple(getattr(self, name) for name in self.names) + (
+                self.force_center, self.force_sign)
+
+    # copy with force_center and/or force_sign changed (falsy values ignored)
+    def forced(self, force_center = None, force_sign = 0):
+        new = FitConstraints(*[getattr(self, name) for name in self.names],
+                force_center = self.force_center, force_sign = self.force_sign)
+        if force_center:
+            new.force_center = force_center
+        if force_sign:
+            new.force_sign = force_sign
+        return new
+
+    # lower and upper bound arrays of (x1, x2, x3, x4), +-inf when unlimited
+    def bounds(self):
+        lower = np.array([-np.inf if x is None else x for x in
+            (self.x1_min, self.x2_min, self.x3_min, self.x4_min)], dtype = float)
+        upper = np.array([np.inf if x is None else x for x in
+            (self.x1_max, self.x2_max, self.x3_max, self.x4_max)], dtype = float)
+        if self.force_center:
+            lower[3] = max(lower[3], self.force_center - 0.02)
+            upper[3] = min(upper[3], self.force_center + 0.02)
+        if self.force_sign > 0:
+            lower[2] = max(lower[2], 0)
+        elif self.force_sign < 0:
+            upper[2] = min(upper[2], 0)
+        for i in np.flatnonzero(lower > upper):
+            raise ValueError("No x{} within the fitting limits ({} to {})".format(
+                i + 1, lower[i], upper[i]))
+        return lower, upper
+
+    def is_bounded(self):
+        lower, upper = self.bounds()
+        return bool(np.isfinite(lower).any() or np.isfinite(upper).any())
+
+    # True if popt is within the limits (force_center/force_sign not checked)
+    def within(self, popt):
+        lower, upper = FitConstraints(*[getattr(self, name) for name in self.names]).bounds()
+        return bool(np.all((popt >= lower) & (popt <= upper)))
+
+# lower and upper bounds (n, 4) of n fits with constraints (None for no
+# limits), x4 of each forced near centers (n,) if given
+def fit_bounds(constraints, n, centers = None):
+    if constraints is None:
+        constraints = FitConstraints()
+    lower, upper = constraints.bounds()
+    lower, upper = np.tile(lower, (n, 1)), np.tile(upper, (n, 1))
+    if centers is not None:
+        lower[:, 3] = np.maximum(lower[:, 3], np.asarray(centers) - 0.02)
+        upper[:, 3] = np.minimum(upper[:, 3], np.asarray(centers) + 0.02)
+    return lower, upper
+
+# True for every fit (row of popt) that ended on one of its bounds
+def at_bounds(popt, lower, upper):
+    popt = np.atleast_2d(popt)
+    near = lambda bound : np.isfinite(bound) & np.isclose(popt, bound, rtol = 1e-6, atol = 1e-12)
+    return (near(lower) | near(upper)).any(axis = 1)
+
+# timings and fit counts of a Squid, cheap enough to be always on.
+# stage(name) times a block of code (calls nested in a block of the same
+# name count once); record_fits counts the fits of a fitting path with
+# their function evaluations (nfev, per fit or per scan of a batch), the fits ending on
+# a limit (bound hits, what used to be the 10000 penalty of rso_response)
+# and the failed fits. start_profile/stop_profile run cProfile meanwhile
+class Fit_stats:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        # name: [calls, seconds]
+        self.stages = {}
+        # path: dict of counts, see record_fits
+        self.fits = {}
+        # function evaluations per scan
+        self.scan_nfev = {}
+        self.profiler = None
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        active = getattr(self.local, 'active', None)
+        if active is None:
+            active = self.local.active = set()
+        if name in active:
+            yield
+            return
+        active.add(name)
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            active.discard(name)
+            self.add_time(name, time.perf_counter() - start)
+
+    def add_time(self, name, seconds, calls = 1):
+        with self.lock:
+            entry = self.stages.setdefault(name, [0, 0.])
+            entry[0] += calls
+            entry[1] += seconds
+
+    def record_fits(self, path, fits = 1, nfev = None, bound_hits = 0, failed = 0,
+            scan = None):
+        with self.lock:
+            entry = self.fits.setdefault(path, dict(fits = 0, nfev = 0, max_nfev = 0,
+                bound_hits = 0, failed = 0))
+            entry['fits'] += fits
+            entry['bound_hits'] += bound_hits
+            entry['failed'] += failed
+            if nfev is None:
+                return
+            # a batch gives nfev and scan per fit
+            nfev = np.atleast_1d(nfev).astype(int)
+            entry['nfev'] += int(nfev.sum())
+            entry['max_nfev'] = max(entry['max_nfev'], int(nfev.max()))
+            if scan is not None:
+                scans = scan if isinstance(scan, list) else [scan]
+                for s, n in zip(scans, nfev):
+                    self.scan_nfev[s] = self.scan_nfev.get(s, 0) + int(n)
+
+    def clear(self):
+        with self.lock:
+            self.stages, self.fits, self.scan_nfev = {}, {}, {}
+
+    # stages and fits as plain dicts, for JSON
+    def as_dict(self):
+        with self.lock:
+            stages = dict((name, dict(calls = calls, seconds = seconds))
+                    for name, (calls, seconds) in self.stages.items())
+            fits = dict((path, dict(entry)) for path, entry in self.fits.items())
+        return dict(stages = stages, fits = fits)
+
+    def start_profile(self):
+        self.stop_profile()
+        self.profiler = cProfile.Profile()
+        self.profiler.enable()
+
+    # stop profiling, saving the profile to fname if given; returns the
+    # pstats.Stats of the profile (None if not profiling)
+    def stop_profile(self, fname = None):
+        if self.profiler is None:
+            return None
+        profiler, self.profiler = self.profiler, None
+        profiler.disable()
+        if fname is not None:
+            profiler.dump_stats(fname)
+        return pstats.Stats(profiler)
+
+# method decorator timing calls as stage name in the object's get_stats()
+def timed_stage(name):
+    def decorate(method):
+        @functools.wraps(method)
+        def timed(self, *args, **kwargs):
+            stats = self.get_stats()
+            if stats is None:
+                return method(self, *args, **kwargs)
+            with stats.stage(name):
+                return method(self, *args, **kwargs)
+        return timed
+    return decorate
 
 # column names in raw squid file
 class colnames:
@@ -72,25 +279,114 @@ class colnames:
     raw_vol = 'Long_Voltage'
     demeaned_vol = 'Long_Demeaned_Voltage'
     demeaned_vol_fit = 'Long_Demeaned_Fit'
+    # the only columns read from raw files
+    used = [time, start_temp, end_temp, field, pos,
+            scaled_vol, raw_vol, demeaned_vol, demeaned_vol_fit]
+
+# structured array dtype of raw data read in
+sqd_dtype = [(c, float) for c in colnames.used]
+
+# lines before the column names in raw squid files
+sqd_header_lines = 30
+
+# raw data is saved next to the source file as <fname>.npy and memory mapped
+# on later loads, as long as the source's modification time is unchanged
+sqd_sidecar = True
+
+# column name as np.genfromtxt(names = True) makes it,
+# e.g. 'Start Temperature (K)' -> 'Start_Temperature_K'
+def sqd_column_name(name):
+    name = name.strip().replace(' ', '_')
+    return ''.join(c for c in name if c not in "~!@#$%^&*()-=+\\|]}[{';: /?.>,<")
+
+# indices of the used columns in a raw squid file and the byte offset
+# of its first row of data
+def sqd_layout(fname):
+    with open(fname, 'rb') as f:
+        for i in range(sqd_header_lines):
+            f.readline()
+        header = f.readline().decode(errors = 'replace')
+        offset = f.tell()
+    names = [sqd_column_name(n) for n in header.split(',')]
+    missing = [c for c in colnames.used if c not in names]
+    if missing:
+        raise ValueError('{} has no column {}'.format(fname, ', '.join(missing)))
+    return [names.index(c) for c in colnames.used], offset
+
+# parse rows of raw squid data, from a file name or from bytes of
+# complete lines, into a structured array of the used columns
+def parse_sqd_rows(source, usecols, skiprows = 0):
+    stream = lambda : io.BytesIO(source) if isinstance(source, bytes) else source
+    try:
+        import pandas
+        frame = pandas.read_csv(stream(), header = None, skiprows = skiprows,
+                usecols = usecols, dtype = float, engine = 'c')
+        columns = [frame[i].to_numpy() for i in usecols]
+    except ImportError:
+        try:
+            table = np.loadtxt(stream(), delimiter = ',', skiprows = skiprows,
+                    usecols = usecols, dtype = float, ndmin = 2)
+        except ValueError:
+            # empty fields, which loadtxt can't read
+            table = np.genfromtxt(stream(), delimiter = ',', skip_header = skiprows,
+                    usecols = usecols, dtype = float).reshape(-1, len(usecols))
+        columns = table.T
+    sqd_data = np.empty(len(columns[0]), dtype = sqd_dtype)
+    for c, column in zip(colnames.used, columns):
+        sqd_data[c] = column
+    return sqd_data
+
+# parse the used columns of a raw squid file into a structured array
+def parse_sqd(fname):
+    usecols, offset = sqd_layout(fname)
+    return parse_sqd_rows(fname, usecols, sqd_header_lines + 1)
 
 # parse and read in raw squid data
 def read_sqd(fname):
-    sqd_data = np.genfromtxt(fname, delimiter = ',',
-            names = True, skip_header = 30)
-    # ignore empty columns
-    columnnames = [n for n in sqd_data.dtype.names if not np.isnan(sqd_data[n][0])]
-    return sqd_data[columnnames]
-
-# separate complete raw sqd array into separate measurements
-def split_sqd(sqd_data):
-    unique_times = sorted(set(sqd_data[colnames.time]))
-    measurements = {}
-    for i, d in enumerate(sqd_data):
-        if not d[colnames.time] in measurements:
-            measurements[d[colnames.time]] = [i]
-        else:
-            measurements[d[colnames.time]].append(i)
-    return [sqd_data[index] for time, index in sorted(measurements.items())]
+    sidecar = fname + '.npy'
+    source = os.stat(fname)
+    if sqd_sidecar:
+        try:
+            if os.stat(sidecar).st_mtime_ns == source.st_mtime_ns:
+                sqd_data = np.load(sidecar, mmap_mode = 'r')
+                if sqd_data.dtype.names == tuple(colnames.used):
+                    return sqd_data
+        except (OSError, ValueError):
+            pass
+    sqd_data = parse_sqd(fname)
+    if sqd_sidecar:
+        # the sidecar gets the source's mtime from before parsing, so a file
+        # written to while it was read is parsed again next time
+        tmp = '{}.{}.tmp'.format(sidecar, os.getpid())
+        try:
+            with open(tmp, 'wb') as f:
+                np.save(f, sqd_data)
+            os.utime(tmp, ns = (source.st_atime_ns, source.st_mtime_ns))
+            os.replace(tmp, sidecar)
+        except OSError as e:
+            print('Could not write {}: {}'.format(sidecar, e))
+            if os.path.exists(tmp):
+                os.remove(tmp)
+    return sqd_data
+
+# sort raw sqd array by time (stable, so rows of a scan keep their order)
+# and find where each measurement starts:
+# measurement i is sqd_data[offsets[i]:offsets[i + 1]]
+def index_sqd(sqd_data):
+    times = sqd_data[colnames.time]
+    if np.any(times[1:] < times[:-1]):
+        sqd_data = sqd_data[np.argsort(times, kind = 'stable')]
+        times = sqd_data[colnames.time]
+    unique_times, starts = np.unique(times, return_index = True)
+    offsets = np.append(starts, len(times))
+    return sqd_data, offsets
+
+# separate complete raw sqd array into separate measurements,
+# views into the time sorted array
+def split_sqd(sqd_data, offsets = None):
+    if offsets is None:
+        sqd_data, offsets = index_sqd(sqd_data)
+    return [sqd_data[a:b] for a, b in zip(offsets[:-1], offsets[1:])]
 
 # use scientific format for graph y axis
 def set_sci_format(*fignums):
@@ -105,10 +401,172 @@ def set_sci_format(*fignums):
             if ax.get_yscale() == 'linear':
                 ax.yaxis.set_major_formatter(formatter)
 
-# window for controlling stuff
+# set the points of plotted series to the values of scans, one array in ys
+# per line, or add them to the points already there; line.scans maps the
+# points back to their scans for picking
+def set_series(lines, scans, x, ys, append = False):
+    for line, y in zip(lines, ys):
+        if append:
+            line.scans = line.scans + list(scans)
+            line.set_data(np.append(line.get_xdata(), x), np.append(line.get_ydata(), y))
+        else:
+            line.scans = list(scans)
+            line.set_data(x, y)
+    for ax in set(line.axes for line in lines):
+        ax.relim()
+        ax.autoscale_view()
+
+# vertical error bars y +- sigma at x in a LineCollection, none for nan sigma
+def set_error_bars(collection, x, y, sigma):
+    shown = np.isfinite(sigma)
+    x, y, sigma = x[shown], y[shown], sigma[shown]
+    collection.set_segments(np.stack([np.stack([x, y - sigma], axis = 1),
+        np.stack([x, y + sigma], axis = 1)], axis = 1))
+
+# empty series line for set_series, picked by clicking within 10 points
+def series_line(ax, color):
+    line, = ax.plot([], [], linestyle = 'none', marker = 'o', color = color,
+            picker = True, pickradius = 10)
+    line.scans = []
+    return line
+
+# redraws the changing (animated) artists of a figure by blitting them over
+# a saved background of everything else; the full draw that saves a new
+# background only happens when an axis' limits no longer suit its data
+class Blitter:
+    def __init__(self, fig, artists):
+        self.fig = fig
+        self.artists = []
+        self.background = None
+        self.add(*artists)
+        fig.canvas.mpl_connect('draw_event', self.on_draw)
+
+    def add(self, *artists):
+        for artist in artists:
+            artist.set_animated(True)
+            self.artists.append(artist)
+
+    # full draws leave out animated artists, so they are drawn here
+    # (also when saving the figure)
+    def on_draw(self, event):
+        canvas = self.fig.canvas
+        if canvas.supports_blit and not canvas.is_saving():
+            self.background = canvas.copy_from_bbox(self.fig.bbox)
+        for artist in self.artists:
+            artist.draw(event.renderer)
+
+    # axes whose data (with that of axes sharing x or y) is outside their
+    # limits or fills less than a quarter of them
+    def stale_axes(self):
+        axes = self.fig.get_axes()
+        for ax in axes:
+            ax.relim()
+        stale = []
+        for ax in axes:
+            view = ax.viewLim
+            xdata = transforms.Bbox.union([a.dataLim
+                for a in ax.get_shared_x_axes().get_siblings(ax)])
+            ydata = transforms.Bbox.union([a.dataLim
+                for a in ax.get_shared_y_axes().get_siblings(ax)])
+            if not np.all(np.isfinite([xdata.x0, xdata.x1, ydata.y0, ydata.y1])):
+                continue
+            outside = (xdata.x0 < view.x0 or xdata.x1 > view.x1 or
+                    ydata.y0 < view.y0 or ydata.y1 > view.y1)
+            small = (0 < xdata.width < 0.25 * view.width or
+                    0 < ydata.height < 0.25 * view.height)
+            if outside or small:
+                stale.append(ax)
+        return stale
+
+    def update(self):
+        stale = self.stale_axes()
+        for ax in stale:
+            ax.autoscale_view()
+        canvas = self.fig.canvas
+        if stale or self.background is None or not canvas.supports_blit:
+            canvas.draw_idle()
+        else:
+            canvas.restore_region(self.background)
+            for artist in self.artists:
+                self.fig.draw_artist(artist)
+            canvas.blit(self.fig.bbox)
+
+# raised by a job's progress function once the job is cancelled
+class Cancelled(Exception):
+    pass
+
+# runs jobs (slow fits) one at a time in a worker thread so the window never
+# freezes; progress and results are passed back as callbacks in a queue that
+# the window thread runs with poll()
+# show(text, fraction) displays the progress of the running job
+class Job_queue:
+    def __init__(self, show):
+        self.show = show
+        self.jobs = queue.Queue()
+        self.callbacks = queue.Queue()
+        self.cancelled = threading.Event()
+        worker = threading.Thread(target = self.run)
+        worker.daemon = True
+        worker.start()
+
+    # func(progress) does the work, calling progress(done, total) as it goes,
+    # which raises Cancelled after cancel(); done(result) is then called
+    # with what func returned, in the window thread
+    def submit(self, name, func, done = None):
+        self.callbacks.put(lambda : self.show('{} (queued)'.format(name), 0))
+        self.jobs.put((name, func, done))
+
+    # stop the running job and drop the queued ones
+    def cancel(self):
+        try:
+            while True:
+                self.jobs.get_nowait()
+        except queue.Empty:
+            pass
+        self.cancelled.set()
+
+    def run(self):
+        while True:
+            name, func, done = self.jobs.get()
+            self.cancelled.clear()
+            def progress(n, total, name = name):
+                if self.cancelled.is_set():
+                    raise Cancelled()
+                self.callbacks.put(lambda : self.show('{}: {}/{}'.format(name, n, total),
+                    float(n) / total))
+            self.callbacks.put(lambda name = name : self.show(name, 0))
+            try:
+                result = func(progress)
+            except Cancelled:
+                self.callbacks.put(lambda name = name : self.show('{} cancelled'.format(name), 0))
+                continue
+            except Exception as e:
+                traceback.print_exc()
+                self.callbacks.put(lambda name = name, e = e :
+                        self.show('{} failed: {}'.format(name, e), 0))
+                continue
+            self.callbacks.put(lambda name = name : self.show('{} done'.format(name), 1))
+            if done is not None:
+                self.callbacks.put(lambda done = done, result = result : done(result))
+
+    # run the callbacks passed back by the worker so far
+    def poll(self):
+        try:
+            while True:
+                self.callbacks.get_nowait()()
+        except queue.Empty:
+            pass
+
+# window for controlling stuff, run in its own thread; ready is set once
+# the widgets exist and the Tk main loop is running
 class Window(threading.Thread):
     def __init__(self,):
         threading.Thread.__init__(self)
+        import_tk()
+        self.ready = threading.Event()
+        # fitting limits entered in the window, None until applied; given to
+        # the Squid loaded later too
+        self.constraints = None
         self.start()
 
     def callback(self):
@@ -117,12 +575,45 @@ class Window(threading.Thread):
     def run(self):
         self.root = tk.Tk()
         self.root.protocol("WM_DELETE_WINDOW", self.callback)
+        self.jobs = Job_queue(self.show_progress)
         self.create_widgets()
-        time.sleep(0.5)
+        self.poll_jobs()
+        self.root.after_idle(self.ready.set)
         self.root.mainloop()
 
+    # wait until the window is ready for use; False if its thread ended
+    # first (Tk failed to start) or after timeout seconds
+    def wait_ready(self, timeout = None):
+        end = None if timeout is None else time.time() + timeout
+        while not self.ready.wait(0.05):
+            if not self.is_alive() or (end is not None and time.time() > end):
+                return False
+        return True
+
+    # results of fits run by self.jobs are applied here, in the Tk thread
+    def poll_jobs(self):
+        self.jobs.poll()
+        self.root.after(100, self.poll_jobs)
+
+    def show_progress(self, text, fraction):
+        self.job_status["text"] = text
+        self.job_progress["value"] = fraction
+
+    # show the selected scan's fits after a job
+    def refresh_scan(self, result = None):
+        self.update_scan_details()
+        self.scan.plot_fit()
+
+    # show every scan's fits after a job
+    def refresh_all(self, result = None):
+        self.refresh_scan()
+        self.squid.plot_dependence()
+        self.squid.plot_params()
+
     def load_squid(self, squid):
         self.squid = squid
+        if self.constraints is not None:
+            self.squid.constraints = self.constraints
         self.total_scans["text"] = "/ {}".format(len(self.squid.scans) - 1)
         self.scan_selector(0)
 
@@ -168,25 +659,30 @@ class Window(threading.Thread):
         self.moment_value.pack(side = "right")
         self.scan_moment.pack(fill = "both", padx = 5, pady = 5)
 
+        # fits run as jobs, in the background
+        # scans are fitted first when lazily loaded, so the background
+        # fitting can't replace the refit
         def rs():
-            self.scan.fit(center = True, print_new_fit = False)
-            self.update_scan_details()
-            self.scan.plot_fit()
+            scan = self.scan
+            def fit(progress):
+                self.squid.ensure_fitted([scan])
+                return scan.fit(center = True, print_new_fit = False)
+            self.jobs.submit('Refit center of scan', fit, self.refresh_scan)
         def ras():
-            self.squid.refit_centers()
-            self.update_scan_details()
-            self.scan.plot_fit()
-            self.squid.plot_dependence()
-            self.squid.plot_params()
+            self.jobs.submit('Refit center of all scans',
+                    lambda progress : self.squid.refit_centers(progress = progress),
+                    self.refresh_all)
         def rss():
-            self.squid.selected_scan.original_fit(center = True,)
-            self.update_scan_details()
-            self.squid.selected_scan.plot_fit()
+            scan = self.squid.selected_scan
+            def fit(progress):
+                self.squid.ensure_fitted([scan])
+                return scan.original_fit(center = True)
+            self.jobs.submit("Recalculate SQUID's fit of scan", fit, self.refresh_scan)
         def rsa():
-            for scan in self.squid.scans:
-                scan.original_fit(center = True,)
-            self.update_scan_details()
-            self.scan.plot_fit()
+            self.jobs.submit("Recalculate SQUID's fit of all scans",
+                    lambda progress : self.squid.original_fit_all(center = True,
+                        progress = progress),
+                    self.refresh_all)
 
         self.refitting = tk.LabelFrame(self.current_scan, text = 'Refitting', labelanchor = "n")
 
@@ -382,8 +878,14 @@ class Window(threading.Thread):
 
        # Frame for general commands
         self.gen_commands = tk.LabelFrame(self.root, text = "Commands", labelanchor = "n")
-        self.refit_all_button = tk.Button(self.gen_commands, text = "Refit all scans")
+        ra = lambda : self.jobs.submit('Refit all scans',
+                lambda progress : self.squid.refit(blocks = True, progress = progress),
+                self.refresh_all)
+        self.refit_all_button = tk.Button(self.gen_commands, text = "Refit all scans",
+                command = ra)
         self.save_to = tk.Button(self.gen_commands, text = "Save as...", command = self.save_fits)
+        self.export_to = tk.Button(self.gen_commands, text = "Export arrays...",
+                command = self.export_fits)
         self.dependence = tk.LabelFrame(self.gen_commands, text = "Independent variable", labelanchor = 'n')
 
        # switch dependence
@@ -399,6 +901,12 @@ class Window(threading.Thread):
 
         dplot = lambda : self.squid.plot_dependence()
         dparam = lambda : self.squid.plot_params()
+        fu = lambda : self.jobs.submit('Moment uncertainties',
+                lambda progress : self.squid.fit_uncertainties(progress = progress),
+                self.refresh_all)
+        cj = lambda : self.jobs.submit('Correct jumps',
+                lambda progress : self.squid.correct_jumps(progress = progress),
+                self.refresh_all)
         iscan = lambda : self.squid.selected_scan.plot_fit()
         gp = lambda : self.squid.selected_scan.update_offset(plot_only = True)
 
@@ -406,56 +914,52 @@ class Window(threading.Thread):
         self.dependence_params = tk.Button(self.replot, text = "Fitting parameters", command = dparam)
         self.individual_scan = tk.Button(self.replot, text = "Selected scan", command = iscan)
         self.gradient_plot = tk.Button(self.replot, text = "Scan gradient", command = gp)
+        self.correct_jumps = tk.Button(self.gen_commands, text = "Correct jumps", command = cj)
         self.save_to.pack()
+        self.export_to.pack()
+        self.refit_all_button.pack(padx = 5, pady = 5)
+        self.correct_jumps.pack(padx = 5, pady = 5)
+        self.uncertainties = tk.Button(self.gen_commands, text = "Moment uncertainties",
+                command = fu)
+        self.uncertainties.pack(padx = 5, pady = 5)
         self.dependence.pack(padx = 5, pady = 5)
         self.dependence_plot.pack(padx = 5, pady = 5, fill = 'both')
         self.dependence_params.pack(padx = 5, pady = 5, fill = 'both')
         self.individual_scan.pack(padx = 5, pady = 5, fill = 'both')
         self.gradient_plot.pack(padx = 5, pady = 5, fill = 'both')
         self.replot.pack(padx = 5, pady = 5)
+
+       # progress of background fitting jobs
+        self.job_frame = tk.LabelFrame(self.gen_commands, text = "Fitting", labelanchor = "n")
+        self.job_status = tk.Label(self.job_frame, text = "", width = 30)
+        self.job_progress = ttk.Progressbar(self.job_frame, length = 150, maximum = 1.0)
+        self.cancel_job = tk.Button(self.job_frame, text = "Cancel", command = self.jobs.cancel)
+        self.job_status.pack(padx = 5)
+        self.job_progress.pack(padx = 5, pady = 5)
+        self.cancel_job.pack(padx = 5, pady = 5)
+        self.job_frame.pack(padx = 5, pady = 5)
         self.gen_commands.grid(row = 0, column = 1, sticky = 'wens', padx = 5, pady = 5)
 
     def update_fitting_lims(self):
-        global x1_min, x2_min, x3_min, x4_min
-        global x1_max, x2_max, x3_max, x4_max
-        try:
-            x1_min = float(self.x1_min.get())
-        except ValueError:
-            x1_min = None
-        try:
-            x2_min = float(self.x2_min.get())
-        except ValueError:
-            x2_min = None
-        try:
-            x3_min = float(self.x3_min.get())
-        except ValueError:
-            x3_min = None
-        try:
-            x4_min = float(self.x4_min.get())
-        except ValueError:
-            x4_min = None
-        try:
-            x1_max = float(self.x1_max.get())
-        except ValueError:
-            x1_max = None
-        try:
-            x2_max = float(self.x2_max.get())
-        except ValueError:
-            x2_max = None
-        try:
-            x3_max = float(self.x3_max.get())
-        except ValueError:
-            x3_max = None
+        lims = []
+        for entry in [self.x1_min, self.x1_max, self.x2_min, self.x2_max,
+                self.x3_min, self.x3_max, self.x4_min, self.x4_max]:
+            try:
+                lims.append(float(entry.get()))
+            except ValueError:
+                lims.append(None)
         try:
-            x4_max = float(self.x4_max.get())
-        except ValueError:
-            x4_max = None
+            self.constraints = FitConstraints(*lims)
+        except ValueError as e:
+            print("Fitting limits not applied: {}".format(e))
+            return
+        if hasattr(self, 'squid'):
+            self.squid.constraints = self.constraints
         print("Fitting limits applied\n"
                 "x1: {}, {}\n"
                 "x2: {}, {}\n"
                 "x3: {}, {}\n"
-                "x4: {}, {}".format(x1_min, x1_max, x2_min, x2_max,
-                    x3_min, x3_max, x4_min, x4_max))
+                "x4: {}, {}".format(*lims))
 
     def clear_fitting_lims(self):
         for x in [self.x1_min_contents, self.x2_min_contents, self.x3_min_contents, self.x4_min_contents,
@@ -537,22 +1041,23 @@ class Window(threading.Thread):
             return
         p0 = [x1, x2, x3, x4]
         scan = self.squid.selected_scan
-        popt, pcov = curve_fit(rso_response, scan.position, scan.voltage, p0 = p0)
+        constraints = self.squid.constraints
+        stats = self.squid.stats
+        def fit(progress):
+            self.squid.ensure_fitted([scan])
+            with stats.stage('optimise'):
+                return fit_rso(scan.position, scan.voltage, p0, constraints, scan.model,
+                        stats, 'optimise', scan)
+        self.jobs.submit('Optimise', fit, lambda result : self.show_optimised(scan, *result))
+
+    def show_optimised(self, scan, popt, pcov, chi2):
         self.x1_opt["text"] = '{:.3e}'.format(popt[0])
         self.x2_opt["text"] = '{:.3e}'.format(popt[1])
         self.x3_opt["text"] = '{:.3e}'.format(popt[2])
         self.x4_opt["text"] = '{:.3e}'.format(popt[3])
-
-        sq_res_sum = sum((rso_response(scan.position, *popt, ignore_lims = True) - scan.voltage)**2)
-        chi2 = sq_res_sum / (len(scan.position) - len(popt))
         self.chi2_opt["text"] = '{:.3e}'.format(chi2)
-        ax1, ax2, ax3, ax4 = self.squid.rmf.get_axes()
-        plt.sca(ax1)
-        fitted_voltage = rso_response(scan.position, *popt, ignore_lims = True)
-        plt.plot(scan.position, fitted_voltage, linestyle = '--', marker = '^')
-        plt.sca(ax3)
-        plt.plot(scan.position, fitted_voltage - scan.voltage, linestyle = '--', marker = '^')
-        self.squid.rmf.canvas.draw()
+        if scan is self.squid.selected_scan:
+            self.squid.plot_trial_fit(popt)
         if chi2 < scan.best_chi2:
             scan.best_popt, scan.best_chi2 = popt, chi2
             self.update_scan_details(scan)
@@ -560,6 +1065,13 @@ class Window(threading.Thread):
     def save_fits(self):
         dump_fit(self.squid)
 
+    def export_fits(self):
+        fname = filedialog.asksaveasfilename(defaultextension = '.npz',
+                filetypes = [('NumPy arrays', '.npz'), ('HDF5', '.h5'),
+                    ('Parquet', '.parquet'), ('All files', '.*')])
+        if fname:
+            export_fits(self.squid, fname)
+
     def switch_dependence(self, dependent):
         if dependent == 'temperature':
             self.temp_dependence["relief"] = 'sunken'
@@ -574,46 +1086,422 @@ class Window(threading.Thread):
 
 # class to contain raw squid data, methods...
 class Squid:
-    def __init__(self, fname, dependent = 'temperature'):
+    # jobs > 1 fits scans in a pool of worker processes
+    # warm_start fits each scan starting from the previous scan's best fit,
+    # which forces the initial fits to run one after another
+    # cache reuses fits of unchanged scans from earlier loads (see Fit_cache)
+    # constraints (FitConstraints) limits the fitted parameters
+    # follow reads the file as it is being written, see follow()
+    # plots = False makes no figures, for use without a display
+    # timings and fit counts are kept in stats (see Fit_stats); profile runs
+    # cProfile from the start, see stats.stop_profile
+    # lazy leaves fitting scans until they are needed (see ensure_fitted),
+    # showing rough SQUID's fits until then while a background thread fits
+    # them in dependence order (see prefetch); lazy fits don't warm start
+    def __init__(self, fname, dependent = 'temperature', jobs = 1, warm_start = True,
+            cache = True, constraints = None, follow = False, plots = True, profile = False,
+            lazy = False):
+        self.stats = Fit_stats()
+        if profile:
+            self.stats.start_profile()
         self.fname = fname
+        self.lazy = lazy
+        if lazy:
+            warm_start = False
+        self.fit_lock = threading.RLock()
+        self.prefetcher = None
+        self.prefetch_stop = threading.Event()
+        # set when the prefetcher has fitted scans not yet plotted
+        self.prefetched = threading.Event()
+        self.prefetch_timer = None
+        self.plots = plots
+        self.constraints = FitConstraints() if constraints is None else constraints
         self.autoupdate_on_click = True
         self.dependent = dependent
+        self.jobs = jobs
+        self.warm_start = warm_start
+        self.fit_cache = None
+        if cache:
+            try:
+                self.fit_cache = Fit_cache(fname)
+            except OSError as e:
+                print("Fit cache disabled: {}".format(e))
+        self.follow_timer = None
+        # without plots follow() checks the file in this thread instead
+        self.follower = None
+        self.follow_stop = threading.Event()
         start_time = time.time()
-        self.raw_data = read_sqd(fname)
-        self.scans = []
-        split_data = split_sqd(self.raw_data)
-        # start fitting from coldest temperature; then sort by time of scan
-        # if dependent variable is temperature
+        # data and fits of all scans, in time order; self.scans[i] is the
+        # view of row i (see ScanTable)
+        self.table = ScanTable(dependent = dependent)
+        if follow:
+            # rows are read from the end of the last complete line read so far
+            # (tail_offset); the last scan may still be being measured, so its
+            # rows are held back in tail_rows until a later scan starts
+            self.sqd_usecols, self.tail_offset = sqd_layout(fname)
+            self.tail_rows = np.empty(0, dtype = sqd_dtype)
+            self.scans = self.append_raw(*self.read_tail())
+        else:
+            with self.stats.stage('read_sqd'):
+                sqd_data = read_sqd(fname)
+            self.scans = self.append_raw(*index_sqd(sqd_data))
+        # start fitting from coldest temperature if dependent variable is
+        # temperature
+        fit_order = self.scans
         if dependent == 'temperature':
-            split_data.sort(key = lambda x : x[colnames.start_temp][0])
-        self.scans.append(Squid_measurement(split_data[0], parent = self, dependent = dependent))
-        for i, s in enumerate(split_data):
-            if not i:
-                continue
-            self.scans.append(Squid_measurement(s, parent = self,
-                dependent = dependent, p0 = self.scans[-1].best_popt))
+            fit_order = sorted(self.scans, key = lambda x : x.start_temp)
+        if lazy:
+            self.estimate_squid_fits(self.scans)
+        else:
+            self.initial_fits(fit_order)
         # clicked_scans contain events
         self.clicked_scans = []
-        for s in self.scans:
-            s.original_fit()
-        self.figures(1, 2, 3, 4)
-        if dependent == 'temperature':
-            self.scans.sort(key = lambda x : x.time)
-        self.select_scan(self.scans[0])
-        self.plot_dependence()
+        if plots:
+            self.figures(1, 2, 3, 4)
+            if self.scans:
+                self.select_scan(self.scans[0])
+            self.plot_dependence()
+        if lazy:
+            self.prefetch()
         
+        self.stats.add_time('load', time.time() - start_time)
         print("\n{:.3f} seconds to load {}".format(time.time() - start_time, fname))
 
+    def get_stats(self):
+        return self.stats
+
+    # stats as a dict for JSON, with the hardest scans to fit (most function
+    # evaluations, index in self.scans)
+    def stats_dict(self, hardest = 10):
+        stats = self.stats.as_dict()
+        index = dict((id(s), i) for i, s in enumerate(self.scans))
+        scan_nfev = sorted(self.stats.scan_nfev.items(), key = lambda x : -x[1])
+        stats['hardest_scans'] = [dict(index = index[id(scan)], nfev = nfev,
+            dependent = float(scan.dependent)) for scan, nfev in scan_nfev
+            if id(scan) in index][:hardest]
+        stats['scans'] = len(self.scans)
+        stats['file'] = self.fname
+        return stats
+
+    def dump_stats(self, fname):
+        with open(fname, 'w') as f:
+            json.dump(self.stats_dict(), f, indent = 2, sort_keys = True)
+
+    def print_stats(self):
+        stats = self.stats_dict()
+        print("{:>20} {:>8} {:>10}".format('Stage', 'Calls', 'Seconds'))
+        for name, entry in sorted(stats['stages'].items(), key = lambda x : -x[1]['seconds']):
+            print("{:>20} {:>8} {:>10.3f}".format(name, entry['calls'], entry['seconds']))
+        print("\n{:>20} {:>8} {:>10} {:>8} {:>10} {:>6}".format('Fits', 'Count', 'nfev',
+            'max nfev', 'Bound hits', 'Failed'))
+        for path, entry in sorted(stats['fits'].items()):
+            print("{:>20} {:>8} {:>10} {:>8} {:>10} {:>6}".format(path, entry['fits'],
+                entry['nfev'], entry['max_nfev'], entry['bound_hits'], entry['failed']))
+        if stats['hardest_scans']:
+            print("\nMost function evaluations: " + ', '.join("scan {} ({})".format(
+                s['index'], s['nfev']) for s in stats['hardest_scans']))
+
+    # first fits of new scans, taken from the cache where possible; with
+    # warm_start each scan starts from the one before it (previous for the
+    # first one, if given)
+    @timed_stage('initial_fits')
+    def initial_fits(self, scans, previous = None):
+        uncached, keys = [], []
+        if self.warm_start:
+            # each scan is looked up once the fit it starts from is known
+            for i, scan in enumerate(scans):
+                p0 = scans[i - 1].best_popt if i else None
+                if previous is not None and not i:
+                    p0 = previous.best_popt
+                key = self.fit_key(scan, p0)
+                if self.load_cached_fit(scan, key):
+                    continue
+                uncached.append(scan)
+                keys.append(key)
+                if p0 is None:
+                    scan.fit(center = True, print_new_fit = False)
+                else:
+                    scan.fit(p0 = p0, print_new_fit = False)
+        else:
+            for scan in scans:
+                key = self.fit_key(scan)
+                if not self.load_cached_fit(scan, key):
+                    uncached.append(scan)
+                    keys.append(key)
+        if uncached and not self.warm_start:
+            # every scan fitted on its own, so they can all be fitted at once
+            popt, pcov, chi2 = self.batch_fit_scans(center_fit_function(), scans = uncached,
+                    constraints = self.constraints)
+            self.table.set_fits(self.rows(uncached), 'best', popt, pcov, chi2)
+        self.original_fit_all(scans = uncached)
+        self.cache_fits(uncached, keys)
+
+    # rough SQUID's fits of scans for lazy loading, see squid_fit_estimates
+    def estimate_squid_fits(self, scans):
+        if not scans:
+            return
+        width = max(len(s.position) for s in self.scans)
+        self.table.squid_estimate[self.rows(scans)] = squid_fit_estimates(
+                [s.position for s in scans], [s.fit_voltage for s in scans], width)
+
+    # fit those of scans (default all) not fitted yet, as initial_fits;
+    # returns the number of scans fitted
+    def ensure_fitted(self, scans = None):
+        if scans is None:
+            scans = self.scans
+        with self.fit_lock:
+            rows = self.rows(scans)
+            missing = (np.isnan(self.table.best_popt[rows, 0]) |
+                    np.isnan(self.table.squid_popt[rows, 0]))
+            pending = [scan for scan, m in zip(scans, missing) if m]
+            if pending:
+                self.initial_fits(pending)
+        return len(pending)
+
+    # fit the scans not fitted yet in the background, in order of the
+    # dependent variable, prefetch_chunk scans at a time; with plots, the
+    # dependence plot is redrawn as they are fitted
+    def prefetch(self):
+        if self.prefetcher is not None and self.prefetcher.is_alive():
+            return
+        self.prefetch_stop.clear()
+        self.prefetcher = threading.Thread(target = self.run_prefetch)
+        self.prefetcher.daemon = True
+        self.prefetcher.start()
+        if self.plots and self.prefetch_timer is None:
+            self.prefetch_timer = self.tdf.canvas.new_timer(interval = 500)
+            self.prefetch_timer.add_callback(self.show_prefetched)
+            self.prefetch_timer.start()
+
+    def run_prefetch(self):
+        start_time = time.time()
+        fitted = 0
+        while not self.prefetch_stop.is_set():
+            missing = (np.isnan(self.table.best_popt[:, 0]) |
+                    np.isnan(self.table.squid_popt[:, 0]))
+            rows = np.flatnonzero(missing)
+            if not len(rows):
+                break
+            rows = rows[np.argsort(self.table.dependent[rows], kind = 'stable')]
+            with self.stats.stage('prefetch'):
+                n = self.ensure_fitted([self.scans[i] for i in rows[:prefetch_chunk]])
+            if not n:
+                break
+            fitted += n
+            self.prefetched.set()
+        print("Prefetched fits of {} scans in {:.2f} s".format(fitted, time.time() - start_time))
+
+    def stop_prefetch(self):
+        self.prefetch_stop.set()
+        if self.prefetcher is not None:
+            self.prefetcher.join()
+
+    # timer callback of prefetch: plot the newly fitted scans, stop the
+    # timer when the prefetcher is done
+    def show_prefetched(self):
+        done = not self.prefetcher.is_alive()
+        if self.prefetched.is_set():
+            self.prefetched.clear()
+            self.plot_dependence()
+        if done and self.prefetch_timer is not None:
+            self.prefetch_timer.stop()
+            self.prefetch_timer = None
+
+    # complete lines added to the file since the last read, returned as the
+    # rows and scan offsets (see index_sqd) of the scans known to be complete
+    # flush also returns the held back last scan
+    @timed_stage('read_sqd')
+    def read_tail(self, flush = False):
+        with open(self.fname, 'rb') as f:
+            f.seek(self.tail_offset)
+            chunk = f.read()
+        end = chunk.rfind(b'\n') + 1
+        rows = self.tail_rows
+        if end:
+            self.tail_offset += end
+            rows = np.concatenate((rows, parse_sqd_rows(chunk[:end], self.sqd_usecols)))
+        rows, offsets = index_sqd(rows)
+        if flush or len(offsets) < 2:
+            complete = len(offsets) - 1
+        else:
+            complete = len(offsets) - 2
+        self.tail_rows = rows[offsets[complete]:].copy()
+        return rows[:offsets[complete]], offsets[:complete + 1]
+
+    # add time sorted rows with scan offsets (see index_sqd) to the table,
+    # returns views of the new scans (not yet in self.scans)
+    @timed_stage('split_sqd')
+    def append_raw(self, rows, offsets):
+        return [Squid_measurement(self.table, row, self)
+                for row in self.table.append(rows, offsets)]
+
+    # fit scans written to the file since the last update and add them to
+    # the dependence plot; flush also takes the last, possibly unfinished scan
+    def update_tail(self, flush = False):
+        new_scans = self.append_raw(*self.read_tail(flush))
+        if not new_scans:
+            return []
+        previous = self.scans[-1] if self.scans else None
+        self.scans.extend(new_scans)
+        if self.lazy:
+            self.estimate_squid_fits(new_scans)
+            self.prefetch()
+        else:
+            self.initial_fits(new_scans, previous)
+        if self.plots:
+            self.plot_dependence_points(new_scans)
+            self.tdf.canvas.draw_idle()
+            if previous is None:
+                self.select_scan(self.scans[0])
+        print("{} new scans in {}".format(len(new_scans), self.fname))
+        return new_scans
+
+    # check the file for new scans every interval seconds
+    # (needs a Squid made with follow = True); with plots a timer of the
+    # dependence figure checks it, else a background thread
+    def follow(self, interval = 2):
+        self.stop_follow(flush = False)
+        if self.plots:
+            self.follow_timer = self.tdf.canvas.new_timer(interval = int(interval * 1000))
+            self.follow_timer.add_callback(self.update_tail)
+            self.follow_timer.start()
+            return
+        self.follow_stop.clear()
+        self.follower = threading.Thread(target = self.run_follow, args = (interval,))
+        self.follower.daemon = True
+        self.follower.start()
+
+    def run_follow(self, interval):
+        while not self.follow_stop.wait(interval):
+            with self.fit_lock:
+                self.update_tail()
+
+    # stop checking for new scans, flush fits the scan held back as unfinished
+    def stop_follow(self, flush = True):
+        if self.follow_timer is not None:
+            self.follow_timer.stop()
+            self.follow_timer = None
+        if self.follower is not None:
+            self.follow_stop.set()
+            self.follower.join()
+            self.follower = None
+        if flush:
+            self.update_tail(flush = True)
+
     def __getitem__(self, k):
         return self.scans[k]
 
     def __len__(self):
         return len(self.scans)
 
+    # run one of the batched fitting functions (batch_curve_fit,
+    # batch_center_fit, varpro_center_fit) over all scans. With jobs > 1 the
+    # scans are split into chunks fitted in worker processes; every scan is
+    # padded to the same width so the results match the serial path exactly
+    # progress(done, total) is called after each chunk of scans is fitted
+    # (serial fits are then split into chunks of progress_chunk scans)
+    # p0 and centers hold one row per scan and are split with the scans
+    # voltage names the data of the scans fitted, or is the data itself (one
+    # array per scan)
+    def batch_fit_scans(self, func, voltage = 'voltage', p0 = None, scans = None,
+            progress = None, progress_chunk = 100, **kwargs):
+        if scans is None:
+            scans = self.scans
+        start_time = time.perf_counter()
+        positions = [s.position for s in scans]
+        if isinstance(voltage, str):
+            voltages = [getattr(s, voltage) for s in scans]
+        else:
+            voltages = list(voltage)
+        width = max(len(s.position) for s in self.scans)
+        if p0 is not None:
+            kwargs['p0'] = p0
+        serial = self.jobs is None or self.jobs < 2 or len(scans) < 2
+        if serial and progress is None:
+            n_chunks = 1
+        elif serial:
+            n_chunks = -(-len(scans) // progress_chunk)
+        else:
+            executor = fit_executor(self.jobs)
+            n_chunks = min(len(scans), 4 * self.jobs)
+        bounds = np.linspace(0, len(scans), n_chunks + 1).astype(int)
+        # chunks as (end of chunk, function returning its results)
+        chunks = []
+        futures = []
+        for start, stop in zip(bounds[:-1], bounds[1:]):
+            chunk_kwargs = dict(kwargs)
+            for name in ('p0', 'centers'):
+                if chunk_kwargs.get(name) is not None:
+                    chunk_kwargs[name] = kwargs[name][start:stop]
+            if serial:
+                chunks.append((stop, lambda start = start, stop = stop, kwargs = chunk_kwargs :
+                    func(positions[start:stop], voltages[start:stop], width = width, **kwargs)))
+            else:
+                futures.append(executor.submit(_batch_fit_worker, func,
+                    positions[start:stop], voltages[start:stop], width,
+                    fit_settings(), chunk_kwargs))
+                chunks.append((stop, futures[-1].result))
+        results = []
+        try:
+            for stop, result in chunks:
+                results.append(result())
+                if progress is not None:
+                    progress(int(stop), len(scans))
+        except Cancelled:
+            for future in futures:
+                future.cancel()
+            raise
+        results = results[0] if len(results) == 1 else [np.concatenate(r) for r in zip(*results)]
+        self.stats.add_time(func.__name__, time.perf_counter() - start_time)
+        # fits return popt, pcov, chi2 and nfev (unlike e.g. resample_fit);
+        # nfev is only recorded, callers get the other three
+        if len(results) == 4:
+            popt, pcov, chi2, nfev = results
+            lower, upper = fit_bounds(kwargs.get('constraints'), len(popt),
+                    kwargs.get('centers'))
+            self.stats.record_fits(func.__name__, len(popt), nfev = nfev,
+                    bound_hits = int(at_bounds(popt, lower, upper).sum()),
+                    failed = int((~np.isfinite(chi2)).sum()), scan = list(scans))
+            results = popt, pcov, chi2
+        return results
+
+    # cache key of scan's initial fit, None without a cache; with warm_start
+    # the fit also depends on p0, the fit it starts from
+    def fit_key(self, scan, p0 = None):
+        if self.fit_cache is None:
+            return None
+        return self.fit_cache.key(scan, self.constraints, p0 = p0,
+                warm_start = self.warm_start)
+
+    # apply the cached fit results under key to scan, False if they aren't
+    # in the cache
+    def load_cached_fit(self, scan, key):
+        if self.fit_cache is None:
+            return False
+        results = self.fit_cache.load(scan.row, key)
+        if results is None:
+            return False
+        for name, value in results.items():
+            setattr(scan, name, value)
+        return True
+
+    # store the current fit results of scans in the cache under keys (see
+    # fit_key). Only initial_fits stores fits: the key holds the load
+    # settings, not those of a refit
+    def cache_fits(self, scans, keys):
+        if self.fit_cache is None:
+            return
+        stored = []
+        for scan, key in zip(scans, keys):
+            results = dict((name, getattr(scan, name)) for name in Fit_cache.fields)
+            if not any(value is None for value in results.values()):
+                stored.append((scan.row, key, results))
+        if stored:
+            self.fit_cache.store(*zip(*stored))
+
     def toggle_dependence(self):
         self.dependent = {'temperature':'field', 'field':'temperature'}[self.dependent]
-        for scan in self.scans:
-            scan.dependent = {'temperature':scan.temperature, 'field':scan.field}[self.dependent]
+        self.table.set_dependent(self.dependent)
         self.plot_dependence()
         self.plot_params()
 
@@ -635,6 +1523,25 @@ class Squid:
             self.tdf = self.temp_dependence_fig[0]
             title = "{} dependence".format('Temperature' if self.dependent == 'temperature' else 'Field')
             plt.suptitle(title)
+            ax1, ax2, ax3 = self.tdf.get_axes()
+            # ax1 for temp/field dependence of magnetization
+            ax1.set_title('Magnetic moment dependence')
+            ax1.set_ylabel('Moment (EMU)')
+            # ax2 for inverse susceptibility, units 1/cm^3
+            ax2.set_title('Inverse susceptibility')
+            ax2.set_ylabel(r'1/$\chi$ (1/cm$^3$)')
+            # ax3 for fit parameter
+            ax3.set_title('Chi2 fitting parameter')
+            ax3.set_ylabel('chi2')
+            ax3.set_yscale('log')
+            # fitted (blue) and SQUID's fit (green) on each axis
+            self.dependence_lines = [series_line(ax, color)
+                    for ax in (ax1, ax2, ax3) for color in ('b', 'g')]
+            # error bars of the fitted moment and inverse susceptibility
+            self.dependence_errors = [LineCollection([], colors = 'b') for ax in (ax1, ax2)]
+            ax1.add_collection(self.dependence_errors[0])
+            ax2.add_collection(self.dependence_errors[1])
+            set_sci_format(self.tdf.number)
             self.tdf.canvas.mpl_connect('pick_event', pe)
             self.tdf.canvas.mpl_connect('button_release_event', bre)
 
@@ -643,6 +1550,10 @@ class Squid:
             self.param_fig = plt.subplots(4, 2, sharex = True, sharey = 'row')
             self.pf = self.param_fig[0]
             plt.suptitle('Fit parameters')
+            # fitted parameters on the left, SQUID's fit on the right
+            self.param_lines = [series_line(ax, 'b') for ax in self.pf.get_axes()]
+            for i, ax in enumerate(self.pf.get_axes()[::2]):
+                ax.set_ylabel('x{}'.format(i + 1))
             self.plot_params()
             self.pf.canvas.mpl_connect('pick_event', pe)
             self.pf.canvas.mpl_connect('button_release_event', bre)
@@ -653,12 +1564,51 @@ class Squid:
             self.offset_fig = plt.subplots(2, sharex = True)
             self.of = self.offset_fig[0]
             plt.suptitle('Slope/offset correction')
+            ax1, ax2 = self.of.get_axes()
+            # ax1 for data + fit
+            ax1.set_ylabel('Scaled voltage (V)')
+            # ax2 for derivative plot
+            ax2.set_xlabel('Position (cm)')
+            ax2.set_ylabel('dV/dx (V/cm)')
+            # voltage and slopes of the scan, then after an offset correction
+            self.of_lines = [ax.plot([], [], linestyle = '--', marker = 'o')[0]
+                    for ax in (ax1, ax2, ax1, ax2)]
+            # index labels of the slopes
+            self.of_texts = []
+            set_sci_format(self.of.number)
+            self.of_blitter = Blitter(self.of, self.of_lines + [self.of.texts[0]])
         
         # figure for individual raw measurement data
         if 4 in args:
             self.raw_measurement_fig = plt.subplots(2, 2, sharex = 'col', sharey = 'row')
             self.rmf = self.raw_measurement_fig[0]
             plt.suptitle('Raw measurement')
+            ax1, ax2, ax3, ax4 = self.rmf.get_axes()
+            # ax1 for raw voltage and best fit
+            ax1.set_title('Best fit')
+            ax1.set_ylabel('Scaled voltage (V)')
+            # ax2 for raw voltage + SQUID fit
+            ax2.set_title('SQUID fit')
+            # ax3 for residuals of raw + best fit
+            ax3.set_xlabel('Position (cm)')
+            ax3.set_ylabel('Scaled voltage residual (V)')
+            # ax4 for residuals of SQUID fit
+            ax4.set_xlabel('Position (cm)')
+            # trial lines show fits tried by click_fit or the window's optimise
+            line = lambda ax, **kwargs : ax.plot([], [], **kwargs)[0]
+            self.rmf_lines = {
+                    'raw':line(ax1, linestyle = '', marker = 'o', label = 'Raw'),
+                    'best':line(ax1, label = 'Best Fit'),
+                    'trial':line(ax1, linestyle = '--', marker = '^'),
+                    'squid_raw':line(ax2, linestyle = '', marker = 'o', label = 'Raw'),
+                    'squid_data':line(ax2, linestyle = '', marker = 'v', label = 'SQUID fit'),
+                    'squid_fit':line(ax2),
+                    'resid':line(ax3, linestyle = '--', marker = 'o'),
+                    'trial_resid':line(ax3, linestyle = '--', marker = '^'),
+                    'squid_resid':line(ax4, linestyle = '--', marker = 'o')}
+            set_sci_format(self.rmf.number)
+            self.rmf_blitter = Blitter(self.rmf,
+                    list(self.rmf_lines.values()) + [self.rmf.texts[0]])
             # fit by clicking
             # self.rmf.canvas.mpl_connect('button_release_event', cfe)
 
@@ -672,14 +1622,18 @@ class Squid:
             return
         click_x, click_y = event.x, event.y
         dists = []
+        scans = []
+        # every point picked on every line, nearest to the click wins
         for s in self.clicked_scans:
-            xy = s.artist.get_xydata()
-            pt_x, pt_y = s.artist.get_axes().transData.transform(xy)[0]
-            dists.append(math.hypot(click_x - pt_x, click_y - pt_y))
-        closest = self.clicked_scans[dists.index(min(dists))]
+            xy = s.artist.get_xydata()[s.ind]
+            pts = s.artist.axes.transData.transform(xy)
+            d = np.hypot(click_x - pts[:, 0], click_y - pts[:, 1])
+            dists.append(d.min())
+            scans.append(s.artist.scans[s.ind[d.argmin()]])
         self.clicked_scans = []
-        self.select_scan(closest.artist.scan)
+        self.select_scan(scans[dists.index(min(dists))])
 
+    @timed_stage('click_fit')
     def click_fit(self, event):
         scan = self.selected_scan
         if event.xdata is None:
@@ -687,15 +1641,9 @@ class Squid:
         center = -event.xdata
         v_range = max(scan.voltage) - min(scan.voltage)
         p0 = [0, 0, v_range/2.65, center] 
-        popt, pcov = curve_fit(rso_response, scan.position, scan.voltage, p0 = p0)
-        sq_res_sum = sum((rso_response(scan.position, *popt, ignore_lims = True) - scan.voltage)**2)
-        chi2 = sq_res_sum / (len(scan.position) - len(popt))
-        ax1, ax2, ax3, ax4 = self.rmf.get_axes()
-        plt.sca(ax1)
-        fitted_voltage = rso_response(scan.position, *popt, ignore_lims = True)
-        plt.plot(scan.position, fitted_voltage, linestyle = '--', marker = '^')
-        plt.sca(ax3)
-        plt.plot(scan.position, fitted_voltage - scan.voltage, linestyle = '--', marker = '^')
+        popt, pcov, chi2 = fit_rso(scan.position, scan.voltage, p0, self.constraints, scan.model,
+                self.stats, 'click_fit', scan)
+        self.plot_trial_fit(popt)
         if chi2 < scan.best_chi2:
             print('Better fit found!')
             if not self.autoupdate_on_click:
@@ -703,150 +1651,118 @@ class Squid:
             else:
                 scan.best_popt, scan.best_chi2 = popt, chi2
 
+    @timed_stage('select_scan')
     def select_scan(self, scan):
         if type(scan) == int:
             scan = self.scans[scan]
+        self.ensure_fitted([scan])
         self.selected_scan = scan
-        try:
-            if plt.fignum_exists(self.parent.of.number):
-                scan.update_offset(plot_only = True)
-        except:
-            pass
-        scan.plot_fit()
-        scan.update_offset(plot_only = True)
         scan_index = self.scans.index(self.selected_scan)
         new_title = 'Scan index {0}, {1} = {2:.2f}'
         title = new_title.format(scan_index, self.dependent, scan.dependent)
         self.rmf.texts[0].set_text(title)
-        self.rmf.canvas.draw()
         self.of.texts[0].set_text(title)
-        self.of.canvas.draw()
+        scan.plot_fit()
+        scan.update_offset(plot_only = True)
+
+    # show a fit of the selected scan with parameters popt next to its best
+    # fit, until another scan is shown
+    @timed_stage('plot_trial_fit')
+    def plot_trial_fit(self, popt):
+        scan = self.selected_scan
+        fitted_voltage = rso_response(scan.position, *popt)
+        self.rmf_lines['trial'].set_data(scan.position, fitted_voltage)
+        self.rmf_lines['trial_resid'].set_data(scan.position, fitted_voltage - scan.voltage)
+        self.rmf_blitter.update()
+
+    # table rows of scans
+    def rows(self, scans):
+        return np.array([s.row for s in scans], dtype = int)
+
+    # dependent variable and fit parameters of scans as arrays; the
+    # SQUID's fits not made yet are estimates (lazy loading)
+    def scan_arrays(self, scans):
+        rows = self.rows(scans)
+        squid = self.table.squid_popt[rows]
+        squid = np.where(np.isnan(squid), self.table.squid_estimate[rows], squid)
+        return self.table.dependent[rows], self.table.best_popt[rows], squid
+
+    # scans with a best fit chi2 below chi2bound, or not fitted yet
+    def plotted_scans(self, chi2bound, scans = None):
+        if scans is None:
+            scans = self.scans
+        keep = ~(self.table.best_chi2[self.rows(scans)] >= chi2bound)
+        return [scan for scan, k in zip(scans, keep) if k]
+
+    # values of the dependence figure's lines for scans
+    def dependence_series(self, scans):
+        x, best, squid = self.scan_arrays(scans)
+        rows = self.rows(scans)
+        field = self.table.field[rows]
+        best_chi2 = self.table.best_chi2[rows]
+        squid_chi2 = self.table.squid_chi2[rows]
+        return x, [best[:, 2], squid[:, 2], field/best[:, 2], field/squid[:, 2],
+                best_chi2, squid_chi2]
+
+    # values of the parameter figure's lines for scans
+    def param_series(self, scans):
+        x, best, squid = self.scan_arrays(scans)
+        return x, [p[:, k] for k in range(4) for p in (best, squid)]
+
+    def dependent_label(self):
+        if self.dependent == 'temperature':
+            return 'Temperature (K)'
+        return 'Applied field (Oe)'
 
+    @timed_stage('plot_dependence')
     def plot_dependence(self, chi2bound = 100):
         try:
-            ax1, ax2, ax3 = self.tdf.get_axes()
-        except:
+            lines = self.dependence_lines
+        except AttributeError:
             self.figures(1)
-            ax1, ax2, ax3 = self.tdf.get_axes()
-        selected_scans = [s for s in self.scans if s.best_chi2 < chi2bound]
+            lines = self.dependence_lines
         title = "{} dependence".format('Temperature' if self.dependent == 'temperature' else 'Field')
         self.tdf.texts[0].set_text(title)
-        # ax1 for temp/field dependence of magnetization
-        plt.sca(ax1)
-        plt.cla()
-        ax1.set_title('Magnetic moment dependence')
-        ax1.set_ylabel('Moment (EMU)')
-        for s in selected_scans:
-            pt, = plt.plot(s.dependent, s.best_popt[2], marker = 'o', color = 'b', picker = 10)
-            pt.scan = s
-            squid_pt, = plt.plot(s.dependent, s.squid_popt[2], marker = 'o', color = 'g', picker = 10)
-            squid_pt.scan = s
-        plt.setp(ax1.get_xticklabels(), visible = False)
-        # ax2 for inverse susceptibility, units 1/cm^3
-        plt.sca(ax2)
-        plt.cla()
-        ax2.set_title('Inverse susceptibility')
-        ax2.set_ylabel(r'1/$\chi$ (1/cm$^3$)')
-        for s in selected_scans:
-            pt, = plt.plot(s.dependent, s.field/s.best_popt[2], marker = 'o', color = 'b', picker = 10)
-            pt.scan = s
-            squid_pt, = plt.plot(s.dependent, s.field/s.squid_popt[2], marker = 'o', color = 'g', picker = 10)
-            squid_pt.scan = s
-        plt.setp(ax2.get_xticklabels(), visible = False)
-        # ax3 for fit parameter
-        plt.sca(ax3)
-        plt.cla()
-        ax3.set_title('Chi2 fitting parameter')
-        ax3.set_ylabel('chi2')
-        if self.dependent == 'temperature':
-            ax3.set_xlabel('Temperature (K)')
-        else:
-            ax3.set_xlabel('Applied field (Oe)')
-        for s in selected_scans:
-            pt, = plt.plot(s.dependent, s.best_chi2, marker = 'o', color = 'b', picker = 10)
-            pt.scan = s
-            squid_pt, = plt.plot(s.dependent, s.squid_chi2, marker = 'o', color = 'g', picker = 10)
-            squid_pt.scan = s
-        ax3.set_yscale('log')
-        set_sci_format(self.tdf.number)
-        self.tdf.canvas.draw()
-
+        self.tdf.get_axes()[2].set_xlabel(self.dependent_label())
+        selected_scans = self.plotted_scans(chi2bound)
+        x, ys = self.dependence_series(selected_scans)
+        set_series(lines, selected_scans, x, ys)
+        # sigma of field/x3 is field sigma(x3)/x3**2
+        sigma = np.array([s.get_best_moment_sigma() for s in selected_scans]) / squid_factor
+        set_error_bars(self.dependence_errors[0], x, ys[0], sigma)
+        set_error_bars(self.dependence_errors[1], x, ys[2], sigma * np.abs(ys[2] / ys[0]))
+        self.tdf.canvas.draw_idle()
+
+    # add the points of scans to the dependence plot
+    @timed_stage('plot_dependence')
+    def plot_dependence_points(self, scans, chi2bound = 100):
+        selected_scans = self.plotted_scans(chi2bound, scans)
+        set_series(self.dependence_lines, selected_scans,
+                *self.dependence_series(selected_scans), append = True)
+
+    @timed_stage('plot_params')
     def plot_params(self, chi2bound = 100):
         try:
-            ax1, ax2, ax3, ax4, ax5, ax6, ax7, ax8 = self.pf.get_axes()
-        except:
+            lines = self.param_lines
+        except AttributeError:
             self.figures(2)
-            ax1, ax2, ax3, ax4, ax5, ax6, ax7, ax8 = self.pf.get_axes()
-        selected_scans = [s for s in self.scans if s.best_chi2 < chi2bound]
-        plt.sca(ax1)
-        plt.cla()
-        ax1.set_ylabel('x1')
-        for s in selected_scans:
-            pt, = plt.plot(s.dependent, s.best_popt[0], marker = 'o', color = 'b', picker = 10)
-            pt.scan = s
-        plt.setp(ax1.get_xticklabels(), visible = False)
-        plt.sca(ax2)
-        plt.cla()
-        for s in selected_scans:
-            pt, = plt.plot(s.dependent, s.squid_popt[0], marker = 'o', color = 'b', picker = 10)
-            pt.scan = s
-        plt.setp(ax2.get_xticklabels(), visible = False)
-        plt.setp(ax2.get_yticklabels(), visible = False)
-        plt.sca(ax3)
-        plt.cla()
-        ax3.set_ylabel('x2')
-        for s in selected_scans:
-            pt, = plt.plot(s.dependent, s.best_popt[1], marker = 'o', color = 'b', picker = 10)
-            pt.scan = s
-        plt.setp(ax3.get_xticklabels(), visible = False)
-        plt.sca(ax4)
-        plt.cla()
-        for s in selected_scans:
-            pt, = plt.plot(s.dependent, s.squid_popt[1], marker = 'o', color = 'b', picker = 10)
-            pt.scan = s
-        plt.setp(ax4.get_xticklabels(), visible = False)
-        plt.setp(ax4.get_yticklabels(), visible = False)
-        plt.sca(ax5)
-        plt.cla()
-        ax5.set_ylabel('x3')
-        for s in selected_scans:
-            pt, = plt.plot(s.dependent, s.best_popt[2], marker = 'o', color = 'b', picker = 10)
-            pt.scan = s
-        plt.setp(ax5.get_xticklabels(), visible = False)
-        plt.sca(ax6)
-        plt.cla()
-        for s in selected_scans:
-            pt, = plt.plot(s.dependent, s.squid_popt[2], marker = 'o', color = 'b', picker = 10)
-            pt.scan = s
-        plt.setp(ax6.get_xticklabels(), visible = False)
-        plt.setp(ax6.get_yticklabels(), visible = False)
-        plt.sca(ax7)
-        plt.cla()
-        if self.dependent == 'temperature':
-            ax7.set_xlabel('Temperature (K)')
-        else:
-            ax7.set_xlabel('Applied field (Oe)')
-        ax7.set_ylabel('x4')
-        for s in selected_scans:
-            pt, = plt.plot(s.dependent, s.best_popt[3], marker = 'o', color = 'b', picker = 10)
-            pt.scan = s
-        plt.sca(ax8)
-        plt.cla()
-        if self.dependent == 'temperature':
-            ax8.set_xlabel('Temperature (K)')
-        else:
-            ax8.set_xlabel('Applied field (Oe)')
-        for s in selected_scans:
-            pt, = plt.plot(s.dependent, s.squid_popt[3], marker = 'o', color = 'b', picker = 10)
-            pt.scan = s
-        plt.setp(ax8.get_yticklabels(), visible = False)
-        set_sci_format(self.pf.number)
-        self.pf.canvas.draw()
+            lines = self.param_lines
+        for ax in self.pf.get_axes()[-2:]:
+            ax.set_xlabel(self.dependent_label())
+        selected_scans = self.plotted_scans(chi2bound)
+        set_series(lines, selected_scans, *self.param_series(selected_scans))
+        self.pf.canvas.draw_idle()
 
     def bad_fits(self, chi2bound):
-        return [s for s in self.scans if s.best_chi2 > chi2bound]
-
-    def refit(self, scans = None, reverse = False, force_sign = 0):
+        return [s for s, x in zip(self.scans, self.table.best_chi2) if x > chi2bound]
+
+    # refit every scan starting from the one before it, with its center
+    # forced near the neighbour's; blocks = True runs refit_blocks instead
+    def refit(self, scans = None, reverse = False, force_sign = 0, blocks = False,
+            progress = None):
+        if blocks:
+            return self.refit_blocks(scans, reverse, force_sign, progress = progress)
+        self.ensure_fitted()
         if scans is None:
             scans = self.scans
         if reverse:
@@ -862,283 +1778,541 @@ class Squid:
                 scan.fit(p0 = scans[i - 2].best_popt,
                         force_center = scans[i-2].best_popt[3])
 
-    def refit_centers(self, force_sign = 0):
+    # refit like refit(), but with the scans sorted by the dependent variable
+    # and split into blocks of block_size (refit_block_size) scans. Each block
+    # starts from a batched center fit and is chained from scan to scan
+    # within the block only, so the k-th scans of all blocks are fitted
+    # together and a bad scan can only spoil the rest of its own block.
+    # Unlike refit(), a scan keeps its fit from before the refit when that is
+    # better than the chained one (and within the limits and force_sign)
+    @timed_stage('refit_blocks')
+    def refit_blocks(self, scans = None, reverse = False, force_sign = 0,
+            block_size = None, progress = None):
+        start_time = time.time()
+        self.ensure_fitted()
+        if scans is None:
+            scans = self.scans
+        if block_size is None:
+            block_size = refit_block_size
+        scans = sorted(scans, key = lambda s : s.dependent, reverse = reverse)
+        if not scans:
+            return
+        blocks = [scans[i:i + block_size] for i in range(0, len(scans), block_size)]
+        # fits from before the refit, that chained fits have to improve on
+        lower, upper = self.constraints.forced(force_sign = force_sign).bounds()
+        previous = dict((id(scan), (scan.best_popt, scan.best_pcov, scan.best_chi2))
+                for scan in scans if scan.best_popt is not None
+                and np.all((scan.best_popt >= lower) & (scan.best_popt <= upper)))
+        # block starts: kept unless the center fit is better, as fit(center = True)
+        heads = [b[0] for b in blocks]
+        popt, pcov, chi2 = self.batch_fit_scans(center_fit_function(), scans = heads,
+                constraints = self.constraints)
+        for scan, p, c, x in zip(heads, popt, pcov, chi2):
+            if (scan.best_popt is None or not self.constraints.within(scan.best_popt)
+                    or x < scan.best_chi2):
+                scan.best_popt, scan.best_pcov, scan.best_chi2 = p, c, x
+        for k in range(1, block_size):
+            chained = [b for b in blocks if len(b) > k]
+            if not chained:
+                break
+            # from the previous scan (replacing the current fit) and from the
+            # one before that (kept if better), both fitted in one batch
+            seeds = [b[k - 1] for b in chained] + [b[k - 2] for b in chained if k > 1]
+            fitted = [b[k] for b in chained] + [b[k] for b in chained if k > 1]
+            p0 = np.array([s.best_popt for s in seeds])
+            n = len(chained)
+            # force_sign only applies to the fit from the previous scan
+            parts = [(0, len(fitted))] if not force_sign else [(0, n), (n, len(fitted))]
+            results = [self.batch_fit_scans(batch_curve_fit, p0 = p0[a:b],
+                scans = fitted[a:b], centers = p0[a:b, 3],
+                constraints = self.constraints.forced(force_sign = force_sign if not a else 0))
+                for a, b in parts if b > a]
+            popt, pcov, chi2 = [np.concatenate(r) for r in zip(*results)]
+            for i, scan in enumerate(fitted[:n]):
+                scan.best_popt, scan.best_pcov, scan.best_chi2 = popt[i], pcov[i], chi2[i]
+                j = n + i
+                if k > 1 and chi2[j] < scan.best_chi2:
+                    scan.best_popt, scan.best_pcov, scan.best_chi2 = popt[j], pcov[j], chi2[j]
+                old = previous.get(id(scan))
+                if old is not None and old[2] < scan.best_chi2:
+                    scan.best_popt, scan.best_pcov, scan.best_chi2 = old
+            if progress is not None:
+                progress(k + 1, block_size)
+        print("Refit {} scans in {} blocks in {:.2f} s".format(len(scans), len(blocks),
+            time.time() - start_time))
+
+    @timed_stage('refit_centers')
+    def refit_centers(self, force_sign = 0, progress = None):
         start_time = time.time()
-        refitted = 0
-        for scan in self.scans:
-            if scan.fit(center = True, force_sign = force_sign, print_new_fit = False):
-                refitted += 1
+        self.ensure_fitted()
+        # all scans (and starting centers) fitted together
+        popt, pcov, chi2 = self.batch_fit_scans(center_fit_function(),
+                constraints = self.constraints.forced(force_sign = force_sign),
+                progress = progress)
+        changed = []
+        for scan, p, c, x in zip(self.scans, popt, pcov, chi2):
+            if (scan.best_popt is None or not self.constraints.within(scan.best_popt)
+                    or x < scan.best_chi2):
+                scan.best_popt, scan.best_pcov, scan.best_chi2 = p, c, x
+                changed.append(scan)
         #self.plot_dependence()
         #self.plot_params()
-        print("Refit {}/{} scans in {:.2f} s".format(refitted, len(self.scans), time.time()- start_time ))
+        print("Refit {}/{} scans in {:.2f} s".format(len(changed), len(self.scans), time.time()- start_time ))
+
+    # remove flux jumps (see find_jumps) from the voltage of every scan and
+    # refit the scans that had any; returns [(scan, indices of its jumps)]
+    # and leaves redrawing the plots to the caller
+    @timed_stage('correct_jumps')
+    def correct_jumps(self, threshold = None, progress = None):
+        self.ensure_fitted()
+        jumps, offsets = find_jumps([s.position for s in self.scans],
+                [s.voltage for s in self.scans], threshold)
+        changed = np.flatnonzero(jumps.any(axis = 1))
+        scans = [self.scans[i] for i in changed]
+        report = [(self.scans[i], np.flatnonzero(jumps[i])) for i in changed]
+        # corrected copies are fitted and only stored with their fits, so a
+        # cancelled job leaves the data and fits unchanged
+        corrected = [scan.voltage - offsets[i, :len(scan.voltage)]
+                for i, scan in zip(changed, scans)]
+        if scans:
+            # fits of the old voltages don't compare, so they are replaced
+            popt, pcov, chi2 = self.batch_fit_scans(center_fit_function(), voltage = corrected,
+                    scans = scans, constraints = self.constraints, progress = progress)
+            for scan, voltage in zip(scans, corrected):
+                scan.voltage = voltage
+            self.table.set_fits(self.rows(scans), 'best', popt, pcov, chi2)
+            # chi2 of the SQUID's fit against the corrected data
+            pos, vol, mask, index_array = pad_scans([s.position for s in scans], corrected)
+            squid_popt = np.array([s.squid_popt for s in scans])
+            squid_chi2 = RsoModel(pos, index_array, mask).chi2(squid_popt, vol)
+            for scan, sx in zip(scans, squid_chi2):
+                scan.squid_chi2 = sx
+        for i, (scan, indices) in zip(changed, report):
+            print("Scan {} ({} = {:.2f}): jumps after points {}".format(i, self.dependent,
+                scan.dependent, ', '.join(str(j) for j in indices)))
+        print("Corrected jumps in {}/{} scans".format(len(scans), len(self.scans)))
+        return report
+
+    # uncertainties of the best fits of all scans by resampling (see
+    # resample_fit), stored in scan.best_sigma
+    @timed_stage('fit_uncertainties')
+    def fit_uncertainties(self, method = 'bootstrap', samples = None, progress = None):
+        start_time = time.time()
+        self.ensure_fitted()
+        p0 = np.array([s.best_popt for s in self.scans])
+        mean, sigma = self.batch_fit_scans(resample_fit, p0 = p0, method = method,
+                samples = samples, constraints = self.constraints, progress = progress)
+        rows = self.rows(self.scans)
+        self.table.best_sigma[rows] = sigma
+        self.table.sigma_popt[rows] = p0
+        print("Uncertainties of {} scans in {:.2f} s".format(len(self.scans),
+            time.time() - start_time))
+
+    # batched equivalent of calling original_fit on every scan (or on scans,
+    # as initial_fits does; all scans are first fitted if lazily loaded)
+    @timed_stage('original_fit_all')
+    def original_fit_all(self, center = False, scans = None, progress = None):
+        if scans is None:
+            self.ensure_fitted()
+            scans = self.scans
+        if not scans:
+            return
+        if center:
+            popt, pcov, chi2 = self.batch_fit_scans(center_fit_function(),
+                    voltage = 'fit_voltage', scans = scans, constraints = self.constraints,
+                    progress = progress)
+        else:
+            p0 = np.array([[0, 0, (max(s.fit_voltage) - min(s.fit_voltage))/2.65, -2]
+                for s in scans])
+            popt, pcov, chi2 = self.batch_fit_scans(batch_curve_fit, voltage = 'fit_voltage',
+                    p0 = p0, scans = scans, constraints = self.constraints,
+                    progress = progress)
+        # chi2 of the SQUID's fit against the actual data
+        pos, vol, mask, index_array = pad_scans([s.position for s in scans],
+                [s.voltage for s in scans])
+        squid_chi2 = RsoModel(pos, index_array, mask).chi2(popt, vol)
+        for scan, p, c, x, sx in zip(scans, popt, pcov, chi2, squid_chi2):
+            if (scan.squid_popt is None or not self.constraints.within(scan.squid_popt)
+                    or x < scan.squid_fit_chi2):
+                scan.squid_popt, scan.squid_pcov, scan.squid_fit_chi2 = p, c, x
+                scan.squid_chi2 = sx
+
+# scans of a raw squid file stored column by column. The per point columns
+# (position, demeaned voltage, scaled voltage and scaled SQUID fit) are
+# single arrays holding scan i at offsets[i]:offsets[i + 1]; per scan
+# values and fit results are arrays with one row per scan, nan where a fit
+# isn't worked out yet; squid_estimate is the quick look at the SQUID's fit
+# of lazy loading (see squid_fit_estimates). Squid_measurement is a view
+# of one row. append adds scans (e.g. from a file being written), the
+# arrays grow by doubling
+class ScanTable:
+    point_columns = ['position', 'demeaned_voltage', 'voltage', 'fit_voltage']
+    # per scan columns and their shape per scan; the fit results start at
+    # best_popt
+    scan_columns = [('time', ()), ('start_temp', ()), ('end_temp', ()),
+            ('temperature', ()), ('delta_temp', ()), ('field', ()),
+            ('scaling_factor', ()), ('dependent', ()),
+            ('best_popt', (4,)), ('best_pcov', (4, 4)), ('best_chi2', ()),
+            ('best_sigma', (4,)), ('sigma_popt', (4,)),
+            ('squid_popt', (4,)), ('squid_pcov', (4, 4)), ('squid_chi2', ()),
+            ('squid_fit_chi2', ()), ('squid_estimate', (4,))]
+    results = [name for name, shape in scan_columns[8:]]
+
+    def __init__(self, sqd_data = None, offsets = None, dependent = 'temperature'):
+        self.dependent_name = dependent
+        self.n_scans = 0
+        self.offsets = np.zeros(1, dtype = int)
+        self.buffers = dict((name, np.empty(0)) for name in self.point_columns)
+        for name, shape in self.scan_columns:
+            self.buffers[name] = np.empty((0,) + shape)
+        self.trim()
+        if sqd_data is not None:
+            self.append(sqd_data, offsets)
+
+    def __len__(self):
+        return self.n_scans
+
+    # columns as attributes, the used part of the buffers
+    def trim(self):
+        for name in self.point_columns:
+            setattr(self, name, self.buffers[name][:self.offsets[-1]])
+        for name, shape in self.scan_columns:
+            setattr(self, name, self.buffers[name][:self.n_scans])
+
+    # make room for n_scans scans of n_points points in all
+    def reserve(self, n_scans, n_points):
+        for name, buffer in self.buffers.items():
+            if name in self.point_columns:
+                size, used = n_points, self.offsets[-1]
+            else:
+                size, used = n_scans, self.n_scans
+            if size > len(buffer):
+                new = np.empty((max(size, 2 * len(buffer)),) + buffer.shape[1:])
+                new[:used] = buffer[:used]
+                self.buffers[name] = new
+
+    # add the time sorted raw rows sqd_data of whole scans, offsets as from
+    # index_sqd; returns the rows of the new scans
+    def append(self, sqd_data, offsets):
+        n, p = self.n_scans, self.offsets[-1]
+        k, m = len(offsets) - 1, offsets[-1]
+        if k < 1:
+            return range(n, n)
+        self.reserve(n + k, p + m)
+        b = self.buffers
+        starts = np.asarray(offsets[:-1])
+        scans, points = slice(n, n + k), slice(p, p + m)
+        for name, column in (('time', colnames.time), ('start_temp', colnames.start_temp),
+                ('end_temp', colnames.end_temp), ('field', colnames.field)):
+            b[name][scans] = sqd_data[column][starts]
+        b['temperature'][scans] = 0.5*(b['start_temp'][scans] + b['end_temp'][scans])
+        b['delta_temp'][scans] = abs(b['start_temp'][scans] - b['end_temp'][scans])
+        # average of scaled/raw voltage where the scaled voltage isn't zero
+        scaled, raw = sqd_data[colnames.scaled_vol], sqd_data[colnames.raw_vol]
+        nonzero = scaled != 0
+        with np.errstate(divide = 'ignore', invalid = 'ignore'):
+            ratio = np.where(nonzero, scaled / raw, 0)
+        b['scaling_factor'][scans] = (np.add.reduceat(ratio, starts) /
+                np.add.reduceat(nonzero, starts))
+        scaling = np.repeat(b['scaling_factor'][scans], np.diff(offsets))
+        b['position'][points] = sqd_data[colnames.pos]
+        b['demeaned_voltage'][points] = sqd_data[colnames.demeaned_vol]
+        b['voltage'][points] = b['demeaned_voltage'][points] * scaling
+        b['fit_voltage'][points] = sqd_data[colnames.demeaned_vol_fit] * scaling
+        for name in self.results:
+            b[name][scans] = np.nan
+        self.offsets = np.append(self.offsets, p + np.asarray(offsets[1:]))
+        self.n_scans += k
+        self.trim()
+        self.set_dependent(self.dependent_name)
+        return range(n, n + k)
+
+    # dependent variable of every scan, 'temperature' or 'field'
+    def set_dependent(self, dependent):
+        self.dependent_name = dependent
+        self.dependent[:] = {'temperature':self.temperature, 'field':self.field}[dependent]
+
+    # store fit results popt, pcov, chi2 of rows as prefix ('best' or 'squid')
+    def set_fits(self, rows, prefix, popt, pcov, chi2):
+        getattr(self, prefix + '_popt')[rows] = popt
+        getattr(self, prefix + '_pcov')[rows] = pcov
+        getattr(self, prefix + '_chi2' if prefix == 'best' else 'squid_fit_chi2')[rows] = chi2
+
+# Squid_measurement property for a per point column of its table: the
+# scan's part of the column, an array view, so changing it in place or
+# assigning an array of the same length changes the table
+def point_property(name):
+    def get(self):
+        offsets = self.table.offsets
+        return getattr(self.table, name)[offsets[self.row]:offsets[self.row + 1]]
+    def set(self, value):
+        get(self)[:] = value
+    return property(get, set)
+
+# Squid_measurement property for a per scan column of its table. Fit
+# results are copies, None where they haven't been worked out (nan), and
+# assigning None clears them
+def scan_property(name):
+    if name not in ScanTable.results:
+        def get(self):
+            return getattr(self.table, name)[self.row]
+    else:
+        def get(self):
+            value = getattr(self.table, name)[self.row]
+            if np.isnan(value).all():
+                return None
+            return value.copy()
+    def set(self, value):
+        getattr(self.table, name)[self.row] = np.nan if value is None else value
+    return property(get, set)
 
 class Squid_measurement:
-    # class to contain individual measurements:
-    def __init__(self, data, p0 = None, parent = None, dependent = 'temperature'):
-        self.data = data
-        self.time = data[colnames.time][0]
-        self.start_temp = data[colnames.start_temp][0]
-        self.end_temp = data[colnames.end_temp][0]
-        self.delta_temp = abs(self.start_temp - self.end_temp)
-        self.temperature = 0.5*(self.start_temp + self.end_temp)
-        self.field = data[colnames.field][0]
-        self.best_popt = None
-        self.best_chi2 = None
-        self.squid_popt = None
-        # squid_chi2 for actual data, squid_fit_chi2 for fit to squid fit
-        self.squid_chi2 = None
-        self.squid_fit_chi2 = None
-        # test for non zero:
-        nzi = np.nonzero(data[colnames.scaled_vol])
-        self.scaling_factor = np.average(data[colnames.scaled_vol][nzi]/data[colnames.raw_vol][nzi])
-        self.position = data[colnames.pos]
-        self.voltage = data[colnames.demeaned_vol] * self.scaling_factor
-        self.fit_voltage = data[colnames.demeaned_vol_fit] * self.scaling_factor
-        if p0 is None:
-            self.fit(center = True, print_new_fit = False)
-        else:
-            self.fit(p0 = p0, print_new_fit = False)
+    # class to contain individual measurements: a view of scan row of a
+    # ScanTable, which holds its data and fits. best_sigma is the
+    # uncertainty of best_popt from Squid.fit_uncertainties, valid while
+    # best_popt is still sigma_popt; squid_chi2 is for the actual data,
+    # squid_fit_chi2 for the fit to the SQUID's fit
+    __slots__ = ['table', 'row', 'parent']
+
+    def __init__(self, table, row, parent = None):
+        self.table = table
+        self.row = row
         self.parent = parent
-        self.dependent = {'temperature':self.temperature,
-                'field':self.field}[dependent]
 
+    position = point_property('position')
+    voltage = point_property('voltage')
+    fit_voltage = point_property('fit_voltage')
+    demeaned_voltage = point_property('demeaned_voltage')
+    time = scan_property('time')
+    start_temp = scan_property('start_temp')
+    end_temp = scan_property('end_temp')
+    temperature = scan_property('temperature')
+    delta_temp = scan_property('delta_temp')
+    field = scan_property('field')
+    scaling_factor = scan_property('scaling_factor')
+    dependent = scan_property('dependent')
+    best_popt = scan_property('best_popt')
+    best_pcov = scan_property('best_pcov')
+    best_chi2 = scan_property('best_chi2')
+    best_sigma = scan_property('best_sigma')
+    sigma_popt = scan_property('sigma_popt')
+    squid_popt = scan_property('squid_popt')
+    squid_pcov = scan_property('squid_pcov')
+    squid_chi2 = scan_property('squid_chi2')
+    squid_fit_chi2 = scan_property('squid_fit_chi2')
+    squid_estimate = scan_property('squid_estimate')
+
+    # made when needed rather than kept for every scan
+    @property
+    def model(self):
+        return RsoModel(self.position)
+
+    # fitting limits of the parent Squid
+    def get_constraints(self):
+        if self.parent is None:
+            return FitConstraints()
+        return self.parent.constraints
+
+    # Fit_stats of the parent Squid, None without one
+    def get_stats(self):
+        if self.parent is None:
+            return None
+        return self.parent.stats
+
+    # fits to fit_voltage, the SQUID's own fit, stored as squid_popt. p0 is
+    # copied, never changed; with center the starting centers come from
+    # center_starts and force_center is not used
+    @timed_stage('original_fit')
     def original_fit(self, center = False, force_center = None, p0 = None,
-            force_sign = 0, force_update = False):
+            force_sign = 0, force_update = False, constraints = None):
+        if constraints is None:
+            constraints = self.get_constraints()
         # check if current fit is outside parameter limits
         if self.squid_popt is not None:
-            if not within_lims(*self.squid_popt):
+            if not constraints.within(self.squid_popt):
                 force_update = True
         if p0 is None:
             # default fitting values
-            # magnitude ~ voltage range / 2.5
-            v_range = max(self.fit_voltage) - min(self.fit_voltage)
-            p0 = [0, 0, v_range/2.65, -2]
+            p0 = [0, 0, 0, -2]
+        p0 = np.array(p0, dtype = float)
         if not p0[2]:
+            # magnitude ~ voltage range / 2.5
             v_range = max(self.fit_voltage) - min(self.fit_voltage)
             p0[2] = v_range/2.65
+        model = self.model
         if center:
-            centers = np.linspace(0.1, 4.1, 9)
-            for c in centers:
-                p0[3] = -c
-                self.original_fit(p0 = p0)
-        ffit = lambda pos, x1, x2, x3, x4: rso_response(pos, x1, x2, x3, x4,
-                force_center = force_center, force_sign = force_sign)
-        if force_center:
-            p0[3] = force_center
-        popt, pcov = curve_fit(ffit, self.position, self.fit_voltage, p0 = p0)
-        sq_res_sum = sum((rso_response(self.position, *popt, ignore_lims = True) - self.fit_voltage)**2)
-        chi2 = sq_res_sum / (len(self.position) - len(popt))
+            forced = constraints.forced(force_sign = force_sign)
+            popt, pcov, chi2 = multistart_fit(self.position, self.fit_voltage,
+                    center_starts(self.position, self.fit_voltage, p0, forced), forced,
+                    model, self.get_stats(), 'original_fit', self)
+            if popt is None:
+                return False
+        else:
+            if force_center:
+                p0[3] = force_center
+            popt, pcov, chi2 = fit_rso(self.position, self.fit_voltage, p0,
+                    constraints.forced(force_center, force_sign), model,
+                    self.get_stats(), 'original_fit', self)
         if force_center or not self.squid_fit_chi2 or chi2 < self.squid_fit_chi2 or force_update:
             self.squid_popt, self.squid_pcov, self.squid_fit_chi2 = popt, pcov, chi2
             # calculate actual chi2
-            sq_res_sum = sum((rso_response(self.position, *popt, ignore_lims = True) - self.voltage)**2)
-            self.squid_chi2 = sq_res_sum / (len(self.position) - len(popt))
+            self.squid_chi2 = model.chi2(popt, self.voltage)
+            return True
+        return False
 
+    # fits to voltage, stored as best_popt if better (or the current fit is
+    # outside the limits); returns whether it changed. p0 is copied, never
+    # changed; with center the starting centers come from center_starts and
+    # force_center is not used
+    @timed_stage('fit')
     def fit(self, center = False, force_center = False, p0 = None,
-            print_new_fit = True, force_update = False, force_sign = 0):
+            print_new_fit = True, force_update = False, force_sign = 0, constraints = None):
+        if constraints is None:
+            constraints = self.get_constraints()
         # check if current fit is outside parameter limits
         if self.best_popt is not None:
-            if not within_lims(*self.best_popt):
+            if not constraints.within(self.best_popt):
                 force_update = True
         if p0 is None:
             # default fitting values
-            # magnitude ~ voltage range / 2.5
-            v_range = max(self.voltage) - min(self.voltage)
-            p0 = [0, 0, v_range/2.65, -2]
+            p0 = [0, 0, 0, -2]
+        p0 = np.array(p0, dtype = float)
         if not p0[2]:
+            # magnitude ~ voltage range / 2.5
             v_range = max(self.voltage) - min(self.voltage)
             p0[2] = v_range/2.65
         old_chi2 = self.best_chi2
         old_popt = self.best_popt
-        if print_new_fit:
+        model = self.model
+        if center:
+            forced = constraints.forced(force_sign = force_sign)
+            popt, pcov, chi2 = multistart_fit(self.position, self.voltage,
+                    center_starts(self.position, self.voltage, p0, forced), forced,
+                    model, self.get_stats(), 'fit', self)
+            if popt is None:
+                return False
+        else:
+            # fit SQUID voltage response
+            if force_center:
+                p0[3] = force_center
+            popt, pcov, chi2 = fit_rso(self.position, self.voltage, p0,
+                    constraints.forced(force_center, force_sign), model,
+                    self.get_stats(), 'fit', self)
+        if not (force_update or not self.best_chi2 or chi2 < self.best_chi2):
+            return False
+        self.best_popt, self.best_pcov, self.best_chi2 = popt, pcov, chi2
+        if print_new_fit and old_popt is not None:
             new_fit_msg = ("Fit parameters changed for temperature {0}:\n"
                     "x1: {1:3e} -> {5:3e}\n"
                     "x2: {2:3e} -> {6:3e}\n"
                     "x3: {3:3e} -> {7:3e}\n"
                     "x4: {4:3e} -> {8:3e}\n"
                     "chi2: {9:3e} -> {10:3e}")
-        if center:
-            # try to fit from muliple center values
-            centers = np.linspace(0.1, 4.1, 9)
-            for c in centers:
-                p0[3] = -c
-                self.fit(p0 = p0, print_new_fit = False,
-                        force_update = False, force_sign = force_sign)
-            if print_new_fit and old_chi2 != self.best_chi2:
-                param_change = ([self.temperature] + list(old_popt) +
-                        list(self.best_popt) + [old_chi2, self.best_chi2])
-                print(new_fit_msg.format(*param_change))
-            if old_chi2 != self.best_chi2:
-                return True
-        # fit SQUID voltage response
-        ffit = lambda pos, x1, x2, x3, x4: rso_response(pos, x1, x2, x3, x4,
-                force_center = force_center, force_sign = force_sign)
-        if force_center:
-            p0[3] = force_center
-        popt, pcov = curve_fit(ffit, self.position, self.voltage, p0 = p0)
-        # calculate fit
-        sq_res_sum = sum((rso_response(self.position, *popt, ignore_lims = True) - self.voltage)**2)
-        chi2 = sq_res_sum / (len(self.position) - len(popt))
-        if print_new_fit and not center and old_chi2 != self.best_chi2:
-            param_change = [self.temperature] + list(old_popt) + list(self.best_popt) + [old_chi2, self.best_chi2]
+            param_change = [self.temperature] + list(old_popt) + list(popt) + [old_chi2, chi2]
             print(new_fit_msg.format(*param_change))
-        if force_update or not self.best_chi2 or chi2 < self.best_chi2:
-            self.best_popt, self.best_pcov, self.best_chi2 = popt, pcov, chi2
-            # not sure why this was being returned
-            # return (popt, pcov, chi2)
-            return True
-        return False
+        return True
 
+    @timed_stage('plot_fit')
     def plot_fit(self):
         try:
-            ax1, ax2, ax3, ax4 = self.parent.rmf.get_axes()
-        except:
+            lines = self.parent.rmf_lines
+        except AttributeError:
             self.parent.figures(4)
-            ax1, ax2, ax3, ax4 = self.parent.rmf.get_axes()
-        # ax1 for raw voltage and best fit
-        plt.sca(ax1)
-        plt.cla()
-        ax1.set_title('Best fit')
-        ax1.yaxis.set_major_formatter(ticker.FormatStrFormatter('%.1e'))
-        ax1.set_ylabel('Scaled voltage (V)')
-        plt.plot(self.position, self.voltage, linestyle = '', marker = 'o', label = 'Raw')
-        y_fit = rso_response(self.position, *self.best_popt, ignore_lims = True)
-        plt.plot(self.position, y_fit, label = 'Best Fit')
-        plt.setp(ax1.get_xticklabels(), visible = False)
-        # ax2 for raw voltage + SQUID fit
-        plt.sca(ax2)
-        plt.cla()
-        ax2.set_title('SQUID fit')
-        plt.plot(self.position, self.voltage, linestyle = '', marker = 'o', label = 'Raw')
-        plt.plot(self.position, self.fit_voltage, linestyle = '', marker = 'v', label = 'SQUID fit')
-        plt.setp(ax2.get_xticklabels(), visible = False)
-        plt.setp(ax2.get_yticklabels(), visible = False)
+            lines = self.parent.rmf_lines
+        y_fit = rso_response(self.position, *self.best_popt)
+        lines['raw'].set_data(self.position, self.voltage)
+        lines['best'].set_data(self.position, y_fit)
+        lines['squid_raw'].set_data(self.position, self.voltage)
+        lines['squid_data'].set_data(self.position, self.fit_voltage)
         if self.squid_popt is not None:
-            y_sqdfit = rso_response(self.position, *self.squid_popt, ignore_lims = True)
-            plt.plot(self.position, y_sqdfit)
-        # ax3 for residuals of raw + best fit
-        plt.sca(ax3)
-        plt.cla()
-        ax3.yaxis.set_major_formatter(ticker.FormatStrFormatter('%.1e'))
-        ax3.set_xlabel('Position (cm)')
-        ax3.set_ylabel('Scaled voltage residual (V)')
-        y_resid = y_fit - self.voltage
-        plt.plot(self.position, y_resid, linestyle = '--', marker = 'o')
-        # ax4 for residuals of SQUID fit
-        plt.sca(ax4)
-        plt.cla()
-        ax4.set_xlabel('Position (cm)')
-        y_sqdresid = self.fit_voltage - self.voltage
-        plt.plot(self.position, y_sqdresid, linestyle = '--', marker = 'o')
-        plt.setp(ax4.get_yticklabels(), visible = False)
-        set_sci_format(self.parent.rmf.number)
-        self.parent.rmf.canvas.draw()
-
+            y_sqdfit = rso_response(self.position, *self.squid_popt)
+            lines['squid_fit'].set_data(self.position, y_sqdfit)
+        else:
+            lines['squid_fit'].set_data([], [])
+        lines['resid'].set_data(self.position, y_fit - self.voltage)
+        lines['squid_resid'].set_data(self.position, self.fit_voltage - self.voltage)
+        lines['trial'].set_data([], [])
+        lines['trial_resid'].set_data([], [])
+        self.parent.rmf_blitter.update()
+
+    # label point i of the slope plot with i
+    def label_slopes(self, mid_pos, slopes):
+        parent = self.parent
+        ax2 = parent.of.get_axes()[1]
+        while len(parent.of_texts) < len(mid_pos):
+            text = ax2.text(0, 0, str(len(parent.of_texts)))
+            parent.of_texts.append(text)
+            parent.of_blitter.add(text)
+        for i, text in enumerate(parent.of_texts):
+            text.set_visible(i < len(mid_pos))
+            if i < len(mid_pos):
+                text.set_position((mid_pos[i], slopes[i]))
+
+    @timed_stage('update_offset')
     def update_offset(self, index = 0, slope = None, plot_only = False):
         try:
-            ax1, ax2 = self.parent.of.get_axes()
-        except:
+            lines = self.parent.of_lines
+        except AttributeError:
             self.parent.figures(3)
-            ax1, ax2 = self.parent.of.get_axes()
-        slopes = []
-        d_vol = []
-        d_pos = []
-        for i in range(len(self.position) - 1):
-            # calcluate slope between successive points
-            d_pos.append(self.position[i + 1] - self.position[i])
-            d_vol.append(self.voltage[i + 1] - self.voltage[i])
-            slopes.append(d_vol[i]/d_pos[i])
+            lines = self.parent.of_lines
+        # slopes between successive points
+        d_pos = np.diff(self.position)
+        d_vol = np.diff(self.voltage)
+        slopes = d_vol / d_pos
+        mid_pos = self.position[:-1] + 0.5 * d_pos
         if not index:
-            fit_figure = self.plot_fit()
-            ax1, ax2 = self.parent.of.get_axes()
-            # ax1 for data + fit
-            plt.sca(ax1)
-            plt.cla()
-            ax1.yaxis.set_major_formatter(ticker.FormatStrFormatter('%.1e'))
-            ax1.set_ylabel('Scaled voltage (V)')
-            plt.plot(self.position, self.voltage, linestyle = '--', marker = 'o')
-            plt.setp(ax1.get_xticklabels(), visible = False)
-            # ax2 for derivative plot
-            plt.sca(ax2)
-            plt.cla()
-            ax2.yaxis.set_major_formatter(ticker.FormatStrFormatter('%.1e'))
-            ax2.set_xlabel('Position (cm)')
-            ax2.set_ylabel('dV/dx (V/cm)')
-            mid_pos = np.array(self.position[:-1]) + np.array(d_pos)
-            plt.plot(mid_pos, slopes, linestyle = '--', marker = 'o')
-            for i in range(len(mid_pos)):
-                plt.text(mid_pos[i], slopes[i], str(i))
+            lines[0].set_data(self.position, self.voltage)
+            lines[1].set_data(mid_pos, slopes)
+            lines[2].set_data([], [])
+            lines[3].set_data([], [])
+            self.label_slopes(mid_pos, slopes)
+            self.parent.of_blitter.update()
             if not plot_only:
                 input_index = input("Index to correct: ")
                 input_slope = input("Correct slope (blank for auto): ")
                 slope = float(input_slope) if input_slope else None
                 if input_index:
                     self.update_offset(index = int(input_index), slope = slope)
-            set_sci_format(self.parent.of.number)
-            self.parent.of.canvas.draw
         else:
             if slope is None:
-                slope = 0.5 * (slopes[index - i] + slopes[index + 1])
+                slope = 0.5 * (slopes[index - 1] + slopes[index + 1])
             slope_fix = slope * d_pos[index]
-            for j in range(index + 1, len(self.voltage)):
-                self.voltage[j] = self.voltage[j] - d_vol[index] + slope_fix
+            # fitted before the data changes, so background fitting can't
+            # replace the fit of the corrected data
+            self.parent.ensure_fitted([self])
+            self.voltage[index + 1:] += slope_fix - d_vol[index]
             self.fit(center = True)
-            ax1, ax2 = self.parent.of.get_axes()
-            plt.sca(ax1)
-            plt.plot(self.position, self.voltage, linestyle = '--', marker = 'o')
-            plt.sca(ax2)
-            mid_pos = np.array(self.position[:-1]) + np.array(d_pos)
-            plt.plot(mid_pos, slopes, linestyle = '--', marker = 'o')
-            self.parent.of.canvas.draw()
+            lines[2].set_data(self.position, self.voltage)
+            lines[3].set_data(mid_pos, slopes)
+            self.parent.of_blitter.update()
 
+    # fits the scan first if it hasn't been (lazy loading)
     def get_best_moment(self):
+        if self.best_popt is None and self.parent is not None:
+            self.parent.ensure_fitted([self])
         return self.best_popt[2] * squid_factor
 
+    # standard deviation of get_best_moment, nan if not worked out for the
+    # current best fit
+    def get_best_moment_sigma(self):
+        if self.best_sigma is None or not np.array_equal(self.sigma_popt, self.best_popt):
+            return np.nan
+        return self.best_sigma[2] * squid_factor
+
     def get_squid_moment(self):
+        if self.squid_popt is None and self.parent is not None:
+            self.parent.ensure_fitted([self])
         return self.squid_popt[2] * squid_factor
 
     def reset_offset(self):
-        self.voltage = self.data[vol]
+        self.voltage = self.demeaned_voltage * self.scaling_factor
 
-def rso_response(pos, x1, x2, x3, x4, force_center = None, force_sign = 0, ignore_lims = False):
+def rso_response(pos, x1, x2, x3, x4):
     # rso scans start and end in middle of scan
     # account for voltage drift as function of time
-    if not ignore_lims:
-        if x1_min is not None:
-            if x1 < x1_min:
-                return 10000
-        if x2_min is not None:
-            if x2 < x2_min:
-                return 10000
-        if x3_min is not None:
-            if x3 < x3_min:
-                return 10000
-        if x4_min is not None:
-            if x4 < x4_min:
-                return 10000
-        if x1_max is not None:
-            if x1 > x1_max:
-                return 10000
-        if x2_max is not None:
-            if x2 > x2_max:
-                return 10000
-        if x3_max is not None:
-            if x3 > x3_max:
-                return 10000
-        if x4_max is not None:
-            if x4 > x4_max:
-                return 10000
-    if force_center:
-        # force x4 within 0.02 cm of given value
-        if force_center - 0.02 > x4 or force_center + 0.02 < x4:
-            return 10000
-    if force_sign:
-        # force sign of magnetization (x3)
-        if force_sign * x3 < 0:
-            return 10000
     # constants
-    R = 0.97
-    L = 1.519
+    R = rso_R
+    L = rso_L
     # index array for voltage drift
     index_array = np.linspace(0, 1, len(pos))
     X = R**2 + (pos + x4)**2
@@ -1146,46 +2320,1018 @@ def rso_response(pos, x1, x2, x3, x4, force_center = None, force_sign = 0, ignor
     Z = R**2 + (-L + (pos + x4))**2
     return x1 + x2 * index_array + x3 * (2 * X**(-3/2) - Y**(-3/2) - Z**(-3/2))
 
-def load_file(fname = None, dep = 'temperature'):
+# analytic jacobian of rso_response, shape (len(pos), 4)
+def rso_jacobian(pos, x1, x2, x3, x4):
+    R = rso_R
+    L = rso_L
+    index_array = np.linspace(0, 1, len(pos))
+    u = pos + x4
+    X = R**2 + u**2
+    Y = R**2 + (L + u)**2
+    Z = R**2 + (-L + u)**2
+    jac = np.empty((len(pos), 4))
+    jac[:, 0] = 1
+    jac[:, 1] = index_array
+    jac[:, 2] = 2 * X**(-3/2) - Y**(-3/2) - Z**(-3/2)
+    # d/dx4 of the dipole response, d(X**(-3/2))/du = -3u X**(-5/2)
+    jac[:, 3] = x3 * (-6 * u * X**(-5/2) + 3 * (L + u) * Y**(-5/2)
+            + 3 * (-L + u) * Z**(-5/2))
+    return jac
+
+# rso_response over scans rows of a padded batch (2D pos, idx, weight) in one
+# pass without temporaries: out[a] is the model of scan rows[a] with
+# parameters popt[a], minus vol and weighted if residual, and jac[a] its
+# weighted jacobian if want_jac. weight and vol may be empty (no weights, no
+# data). Returns the sum of squares of out per row. Plain Python, compiled
+# by numba through rso_kernel, with rso_R and rso_L fixed when compiled
+def _rso_kernel(pos, idx, weight, vol, popt, rows, residual, want_jac, out, jac):
+    R2 = rso_R**2
+    L = rso_L
+    weighted = weight.shape[0] > 0
+    ssr = np.zeros(len(rows))
+    for a in range(len(rows)):
+        i = rows[a]
+        x1, x2, x3, x4 = popt[a, 0], popt[a, 1], popt[a, 2], popt[a, 3]
+        for j in range(pos.shape[1]):
+            u = pos[i, j] + x4
+            X = R2 + u * u
+            Y = R2 + (L + u) * (L + u)
+            Z = R2 + (u - L) * (u - L)
+            # W**(-5/2) and W**(-3/2) = W * W**(-5/2) without power calls
+            X5 = 1. / (X * X * math.sqrt(X))
+            Y5 = 1. / (Y * Y * math.sqrt(Y))
+            Z5 = 1. / (Z * Z * math.sqrt(Z))
+            g = 2 * X * X5 - Y * Y5 - Z * Z5
+            w = weight[i, j] if weighted else 1.
+            v = x1 + x2 * idx[i, j] + x3 * g
+            if residual:
+                v = (v - vol[i, j]) * w
+            out[a, j] = v
+            ssr[a] += v * v
+            if want_jac:
+                jac[a, j, 0] = w
+                jac[a, j, 1] = idx[i, j] * w
+                jac[a, j, 2] = g * w
+                jac[a, j, 3] = x3 * (-6 * u * X5 + 3 * (L + u) * Y5
+                        + 3 * (u - L) * Z5) * w
+    return ssr
+
+_compiled_kernel = None
+# _rso_kernel compiled for model_backend, None for the NumPy kernels. numba
+# is imported and the kernel compiled (or loaded from numba's cache) on
+# first use; with 'auto' a missing numba falls back to NumPy (remembered as
+# False), with 'numba' it raises ImportError every time
+def rso_kernel():
+    global _compiled_kernel
+    if model_backend == 'numpy':
+        return None
+    if _compiled_kernel is None or (_compiled_kernel is False and model_backend == 'numba'):
+        try:
+            import numba
+            _compiled_kernel = numba.njit(cache = True)(_rso_kernel)
+        except ImportError:
+            if model_backend == 'numba':
+                raise
+            _compiled_kernel = False
+    return _compiled_kernel or None
+
+# rso_response for one scan (1D position) or a zero padded batch of scans
+# (2D position and mask from pad_scans). Position dependent arrays and work
+# buffers are set up once, so evaluate, residual and chi2 run in place
+# without allocating. Results are views of internal buffers that the next
+# call overwrites; copy them to keep them. rows selects scans of a batch
+# The kernels are rso_kernel when model_backend gives one, else NumPy
+class RsoModel:
+    def __init__(self, position, index_array = None, mask = None):
+        self.position = np.asarray(position, dtype = float)
+        shape = self.position.shape
+        if index_array is None:
+            index_array = np.linspace(0, 1, shape[-1])
+        self.index_array = np.ascontiguousarray(np.broadcast_to(index_array, shape))
+        # zero weight for padding, residuals there are always 0
+        self.weight = None if mask is None else np.asarray(mask, dtype = float)
+        n_points = shape[-1] if mask is None else self.weight.sum(axis = -1)
+        self.dof = n_points - 4
+        self._u, self._v, self._X, self._Y, self._Z, self._out = [np.empty(shape) for i in range(6)]
+        self._jac = np.empty(shape + (4,))
+        if self.position.ndim == 2:
+            # geometry of a subset of rows is copied here
+            self._pos, self._idx, self._w, self._vol = [np.empty(shape) for i in range(4)]
+        self.kernel = rso_kernel()
+        if self.kernel is not None:
+            # 2D views for the compiled kernel, a 1D scan being one row
+            width = shape[-1]
+            self._pos2d = self.position.reshape(-1, width)
+            self._idx2d = self.index_array.reshape(-1, width)
+            self._w2d = (np.empty((0, 0)) if self.weight is None else
+                    np.ascontiguousarray(self.weight).reshape(-1, width))
+            self._out2d = self._out.reshape(-1, width)
+            self._jac2d = self._jac.reshape(-1, width, 4)
+            self._all_rows = np.arange(len(self._pos2d))
+
+    # (out, ssr, jac) of the compiled kernel, out and jac shaped like the
+    # results of the NumPy kernels
+    def _compiled(self, popt, voltage, rows, residual, want_jac):
+        popt = np.asarray(popt, dtype = float).reshape(-1, 4)
+        rows = self._all_rows if rows is None else np.asarray(rows, dtype = np.intp)
+        width = self._pos2d.shape[1]
+        vol = np.empty((0, 0)) if voltage is None else np.asarray(voltage,
+                dtype = float).reshape(-1, width)
+        k = len(rows)
+        out, jac = self._out2d[:k], self._jac2d[:k]
+        ssr = self.kernel(self._pos2d, self._idx2d, self._w2d, vol, popt, rows,
+                residual, want_jac, out, jac)
+        if self.position.ndim == 1:
+            return out[0], ssr[0], jac[0]
+        return out, ssr, jac
+
+    def _rows(self, rows):
+        if rows is None:
+            return slice(None), self.position, self.index_array, self.weight
+        k = slice(0, len(rows))
+        pos = np.take(self.position, rows, axis = 0, out = self._pos[k])
+        idx = np.take(self.index_array, rows, axis = 0, out = self._idx[k])
+        w = None
+        if self.weight is not None:
+            w = np.take(self.weight, rows, axis = 0, out = self._w[k])
+        return k, pos, idx, w
+
+    def _params(self, popt):
+        if self.position.ndim == 1:
+            return popt
+        return [popt[:, i, None] for i in range(4)]
+
+    # u = pos + x4 and the X, Y, Z terms of rso_response, before the -3/2 power
+    def _geometry(self, k, pos, x4):
+        R2 = rso_R**2
+        u, X, Y, Z = self._u[k], self._X[k], self._Y[k], self._Z[k]
+        np.add(pos, x4, out = u)
+        np.multiply(u, u, out = X)
+        X += R2
+        np.add(u, rso_L, out = Y)
+        np.multiply(Y, Y, out = Y)
+        Y += R2
+        np.subtract(u, rso_L, out = Z)
+        np.multiply(Z, Z, out = Z)
+        Z += R2
+        return u, X, Y, Z
+
+    def evaluate(self, popt, rows = None):
+        if self.kernel is not None:
+            return self._compiled(popt, None, rows, False, False)[0]
+        k, pos, idx, w = self._rows(rows)
+        x1, x2, x3, x4 = self._params(popt)
+        u, X, Y, Z = self._geometry(k, pos, x4)
+        out = self._out[k]
+        np.power(X, -1.5, out = X)
+        np.power(Y, -1.5, out = Y)
+        np.power(Z, -1.5, out = Z)
+        np.multiply(X, 2, out = out)
+        out -= Y
+        out -= Z
+        out *= x3
+        out += x1
+        np.multiply(idx, x2, out = u)
+        out += u
+        return out
+
+    # model - voltage, zero at padding
+    def residual(self, popt, voltage, rows = None):
+        if self.kernel is not None:
+            return self._compiled(popt, voltage, rows, True, False)[0]
+        out = self.evaluate(popt, rows)
+        if rows is not None:
+            voltage = np.take(voltage, rows, axis = 0, out = self._vol[:len(rows)])
+        out -= voltage
+        if self.weight is not None:
+            out *= self.weight if rows is None else self._w[:len(rows)]
+        return out
+
+    # reduced chi2, a float for a single scan or an array for a batch
+    def chi2(self, popt, voltage, rows = None):
+        dof = self.dof if rows is None else self.dof[rows]
+        if self.kernel is not None:
+            return self._compiled(popt, voltage, rows, True, False)[1] / dof
+        res = self.residual(popt, voltage, rows)
+        return np.einsum('...i,...i->...', res, res) / dof
+
+    # residual, chi2 and jacobian at once, in a single pass with the compiled
+    # kernel; res and jac are internal buffers as for residual and jacobian
+    def residual_jacobian(self, popt, voltage, rows = None):
+        dof = self.dof if rows is None else self.dof[rows]
+        if self.kernel is not None:
+            res, ssr, jac = self._compiled(popt, voltage, rows, True, True)
+            return res, ssr / dof, jac
+        # jacobian first, it uses the buffer residual returns
+        jac = self.jacobian(popt, rows)
+        res = self.residual(popt, voltage, rows)
+        return res, np.einsum('...i,...i->...', res, res) / dof, jac
+
+    # jacobian with respect to (x1, x2, x3, x4), shape position.shape + (4,)
+    def jacobian(self, popt, rows = None):
+        if self.kernel is not None:
+            return self._compiled(popt, None, rows, False, True)[2]
+        k, pos, idx, w = self._rows(rows)
+        x1, x2, x3, x4 = self._params(popt)
+        u, X, Y, Z = self._geometry(k, pos, x4)
+        v, out, jac = self._v[k], self._out[k], self._jac[k]
+        # d(X**(-3/2))/du = -3u X**(-5/2), and X**(-3/2) = X * X**(-5/2)
+        np.power(X, -2.5, out = v)
+        X *= v
+        v *= u
+        np.multiply(v, -6, out = jac[..., 3])
+        for W, shift in ((Y, rso_L), (Z, -rso_L)):
+            np.power(W, -2.5, out = v)
+            W *= v
+            np.add(u, shift, out = out)
+            v *= out
+            v *= 3
+            jac[..., 3] += v
+        jac[..., 3] *= x3
+        np.multiply(X, 2, out = out)
+        out -= Y
+        out -= Z
+        jac[..., 2] = out
+        jac[..., 1] = idx
+        jac[..., 0] = 1
+        if w is not None:
+            jac *= w[..., None]
+        return jac
+
+# least squares fit of rso_response to one scan within constraints, with the
+# trust region reflective solver when there are bounds. Parameters fixed by
+# the constraints (lower == upper) are left out of the fit, as curve_fit
+# needs lower < upper
+# model is the scan's RsoModel, made from position if not given
+# returns popt, pcov and reduced chi2
+# stats (Fit_stats) counts the fit as one of path, for scan
+def fit_rso(position, voltage, p0, constraints = None, model = None, stats = None,
+        path = 'fit', scan = None):
+    from scipy.optimize import curve_fit
+    if constraints is None:
+        constraints = FitConstraints()
+    if model is None:
+        model = RsoModel(position)
+    lower, upper = constraints.bounds()
+    bounded = constraints.is_bounded()
+    free = lower < upper
+    # full parameters from the free ones q
+    def params(q):
+        popt = lower.copy()
+        popt[free] = q
+        return popt
+    # curve_fit subtracts the data from the returned buffer, making a new
+    # array, but keeps the jacobian it is given, so that is copied (by
+    # picking the free columns)
+    f = lambda pos, *q: model.evaluate(params(q))
+    jac = lambda pos, *q: model.jacobian(params(q))[:, free]
+    pcov = np.zeros((4, 4))
+    try:
+        if not free.any():
+            q, qcov, info = [], np.zeros((0, 0)), dict(nfev = 0)
+        elif bounded:
+            p0 = np.clip(np.asarray(p0, dtype = float), lower, upper)
+            q, qcov, info, message, status = curve_fit(f, position, voltage, p0 = p0[free],
+                    jac = jac, bounds = (lower[free], upper[free]), method = 'trf',
+                    full_output = True)
+        else:
+            q, qcov, info, message, status = curve_fit(f, position, voltage, p0 = p0,
+                    jac = jac, full_output = True)
+    except (RuntimeError, ValueError):
+        if stats is not None:
+            stats.record_fits(path, failed = 1)
+        raise
+    popt = params(q)
+    pcov[np.ix_(free, free)] = qcov
+    chi2 = model.chi2(popt, voltage)
+    if stats is not None:
+        stats.record_fits(path, nfev = int(info['nfev']),
+                bound_hits = int(bounded and at_bounds(popt[free], lower[free], upper[free])[0]),
+                failed = int(not np.isfinite(chi2)), scan = scan)
+    return popt, pcov, chi2
+
+# starting parameters (n, 4) of a center search of one scan from p0: the
+# best center of the separable search for center_search 'varpro', else p0
+# with each of the multistart centers (without repeats), nearest p0's
+# center first
+def center_starts(position, voltage, p0, constraints = None):
+    if center_search == 'varpro':
+        return varpro_starts([position], [voltage], constraints)
+    centers = np.unique(np.round(multistart_centers, 6))
+    centers = centers[np.argsort(np.abs(centers + p0[3]), kind = 'stable')]
+    starts = np.tile(np.asarray(p0, dtype = float), (len(centers), 1))
+    starts[:, 3] = -centers
+    return starts
+
+# multistart planner: fit_rso from each of starts in turn, keeping the best
+# fit. Starts whose center is within multistart_center_tol of a center
+# already converged to are skipped, as they would find the same minimum,
+# and the search stops after multistart_patience starts in a row without a
+# better chi2. A start that fails to fit is passed over
+# returns popt, pcov, chi2 of the best fit, all None if none succeeded
+def multistart_fit(position, voltage, starts, constraints = None, model = None,
+        stats = None, path = 'fit', scan = None):
+    if model is None:
+        model = RsoModel(position)
+    best = (None, None, None)
+    converged = []
+    stale = 0
+    for p0 in starts:
+        if any(abs(p0[3] - x4) < multistart_center_tol for x4 in converged):
+            continue
+        try:
+            popt, pcov, chi2 = fit_rso(position, voltage, np.array(p0, dtype = float),
+                    constraints, model, stats, path, scan)
+        except (RuntimeError, ValueError):
+            if len(starts) == 1:
+                raise
+            continue
+        converged.append(popt[3])
+        if best[2] is None or chi2 < best[2]:
+            best = (popt, pcov, chi2)
+            stale = 0
+        else:
+            stale += 1
+            if stale >= multistart_patience:
+                break
+    return best
+
+# stack ragged scans into zero padded 2D arrays for batch fitting
+# width can be fixed so results don't depend on which scans share a batch
+def pad_scans(positions, voltages, width = None):
+    lengths = np.array([len(p) for p in positions])
+    if width is None:
+        width = lengths.max()
+    pos = np.zeros((len(positions), width))
+    vol = np.zeros((len(positions), width))
+    mask = np.zeros((len(positions), width), dtype = bool)
+    for i, (p, v) in enumerate(zip(positions, voltages)):
+        pos[i, :len(p)] = p
+        vol[i, :len(v)] = v
+        mask[i, :len(p)] = True
+    # same values as np.linspace(0, 1, len(pos)) for every row
+    index_array = np.arange(width) * (1.0 / np.maximum(lengths - 1, 1))[:, None]
+    index_array[np.arange(len(positions)), lengths - 1] = 1.0
+    return pos, vol, mask, index_array
+
+# flux jumps: steps between successive points of a scan. With x4 from the
+# separable center search the scan is fitted, linearised in x4, as a linear
+# least squares; a step at a gap then lowers chi2 by z**2 times the noise
+# variance, z being the step's share of the residual over its own norm. The
+# noise is the robust spread (scaled median absolute deviation) of successive
+# residual differences, which a few jumps leave alone. The gap with the
+# largest z is a jump when z exceeds jump_threshold; it joins the fit and the
+# next is looked for, up to max_jumps per scan. On sqdr_synthetic scans with
+# 2% noise, jump_threshold = 5 finds a jump in 0.25% of scans without one and
+# finds 86% of steps of 10% of the moment and all of 20% and more
+jump_threshold = 5
+max_jumps = 3
+
+# find flux jumps in many scans at once; returns jumps (n, width - 1), True
+# where a scan jumps between points i and i + 1, and offsets (n, width), the
+# cumulative jump to subtract from each point of each scan
+def find_jumps(positions, voltages, threshold = None, width = None):
+    if threshold is None:
+        threshold = jump_threshold
+    pos, vol, mask, index_array = pad_scans(positions, voltages, width)
+    x4 = varpro_starts(positions, voltages, width = pos.shape[1])[:, 3]
+    jumps = np.zeros((len(pos), pos.shape[1] - 1), dtype = bool)
+    offsets = np.zeros(vol.shape)
+    # keep the (scans, points, gaps) arrays of fit_steps to ~2M elements
+    chunk = max(1, 2**21 // pos.shape[1]**2)
+    for start in range(0, len(pos), chunk):
+        rows = slice(start, start + chunk)
+        jumps[rows], offsets[rows] = fit_steps(pos[rows], vol[rows],
+                mask[rows], index_array[rows], x4[rows], threshold)
+    return jumps, offsets
+
+# the step search of find_jumps for padded scans with centers x4 (n,)
+def fit_steps(pos, vol, mask, index_array, x4, threshold):
+    n, m = pos.shape
+    scans = np.arange(n)
+    w = mask.astype(float)
+    u = pos + x4[:, None]
+    X = rso_R**2 + u**2
+    Y = rso_R**2 + (rso_L + u)**2
+    Z = rso_R**2 + (u - rso_L)**2
+    g = 2 * X**-1.5 - Y**-1.5 - Z**-1.5
+    dg = -6 * u * X**-2.5 + 3 * (rso_L + u) * Y**-2.5 + 3 * (u - rso_L) * Z**-2.5
+    basis = np.stack([w, index_array * w, g * w, dg * w], axis = 2)
+    # steps[:, i, k] is 1 for the points i after gap k
+    steps = (np.arange(m)[:, None] > np.arange(m - 1)).astype(float) * w[:, :, None]
+    y = vol * w
+    jumps = np.zeros((n, m - 1), dtype = bool)
+    found = []
+    for _ in range(max_jumps):
+        proj = np.linalg.pinv(basis)
+        res = y - np.einsum('nmc,nc->nm', basis, np.einsum('ncm,nm->nc', proj, y))
+        free = steps - np.einsum('nmc,nck->nmk', basis,
+                np.einsum('ncm,nmk->nck', proj, steps))
+        num = np.einsum('nmk,nm->nk', free, res)
+        den = np.einsum('nmk,nmk->nk', free, free)
+        diffs = np.where(mask[:, 1:], np.diff(res, axis = 1), np.nan)
+        deviation = np.abs(diffs - np.nanmedian(diffs, axis = 1)[:, None])
+        noise = 1.4826 / np.sqrt(2) * np.nanmedian(deviation, axis = 1)
+        # noiseless scans
+        noise = np.maximum(noise, 1e-9 * np.abs(y).max(axis = 1) + 1e-300)
+        z = np.where(den > 1e-9, np.abs(num) / np.sqrt(np.maximum(den, 1e-300)), 0.)
+        z = np.where(jumps, 0., z / noise[:, None])
+        gap = np.argmax(z, axis = 1)
+        hit = z[scans, gap] > threshold
+        if not hit.any():
+            break
+        jumps[scans[hit], gap[hit]] = True
+        column = np.where(hit[:, None], steps[scans, :, gap], 0.)
+        basis = np.concatenate([basis, column[:, :, None]], axis = 2)
+        found.append(column)
+    offsets = np.zeros(vol.shape)
+    if found:
+        # step heights from the fit with every jump found
+        heights = np.einsum('ncm,nm->nc', np.linalg.pinv(basis), y)[:, 4:]
+        offsets = np.einsum('nmc,nc->nm', np.stack(found, axis = 2), heights)
+    return jumps, offsets
+
+# Levenberg-Marquardt for many scans at once, one batched RsoModel call per
+# iteration. Parameters are kept inside the constraints by projection;
+# centers (n,) forces x4 of every scan like FitConstraints.force_center.
+# Returns popt (n, 4), pcov (n, 4, 4) and reduced chi2 (n,) like curve_fit,
+# and nfev (n,), the residual evaluations of every scan
+def batch_curve_fit(positions, voltages, p0, constraints = None,
+        width = None, max_iter = 200, ftol = 1.49012e-8, xtol = 1.49012e-8,
+        centers = None):
+    pos, vol, mask, index_array = pad_scans(positions, voltages, width)
+    return padded_curve_fit(pos, vol, mask, index_array, p0, constraints,
+            max_iter, ftol, xtol, centers)
+
+# solutions of the damped normal equations damped @ step = -g of many scans
+def lm_steps(damped, g):
+    try:
+        return np.linalg.solve(damped, -g[:, :, None])[:, :, 0]
+    except np.linalg.LinAlgError:
+        # solve row by row so a singular scan doesn't affect the others
+        step = np.empty_like(g)
+        for k in range(len(g)):
+            try:
+                step[k] = np.linalg.solve(damped[k:k + 1], -g[k:k + 1, :, None])[0, :, 0]
+            except np.linalg.LinAlgError:
+                step[k] = np.linalg.lstsq(damped[k], -g[k], rcond = None)[0]
+        return step
+
+# batch_curve_fit of scans padded as by pad_scans; points where mask is
+# False are left out of the fit
+def padded_curve_fit(pos, vol, mask, index_array, p0, constraints = None,
+        max_iter = 200, ftol = 1.49012e-8, xtol = 1.49012e-8, centers = None):
+    n = len(pos)
+    dof = mask.sum(axis = 1) - 4
+    lower, upper = fit_bounds(constraints, n, centers)
+    popt = np.clip(np.array(p0, dtype = float).reshape(n, 4), lower, upper)
+
+    model = RsoModel(pos, index_array, mask)
+    res, chi2, jac = model.residual_jacobian(popt, vol)
+    res = res.copy()
+    ssr = (res**2).sum(axis = 1)
+    lam = np.full(n, 1e-3)
+    nfev = np.ones(n, dtype = int)
+    active = np.isfinite(ssr)
+    jac = np.where(active[:, None, None], jac, 0.)
+    for it in range(max_iter):
+        rows = np.flatnonzero(active)
+        if not len(rows):
+            break
+        J = jac[rows]
+        JT = J.transpose(0, 2, 1)
+        A = np.matmul(JT, J)
+        g = np.matmul(JT, res[rows][:, :, None])[:, :, 0]
+        diag = np.diagonal(A, axis1 = 1, axis2 = 2)
+        diag = np.maximum(diag, 1e-12 * diag.max(axis = 1, keepdims = True) + 1e-300)
+        damped = A + lam[rows, None, None] * (diag[:, :, None] * np.eye(4))
+        step = lm_steps(damped, g)
+        # parameters the step pushes against their bound are held there and
+        # the step of the others solved again, so a scan with an active bound
+        # (e.g. a forced center) still converges in the free parameters
+        held = (((popt[rows] <= lower[rows]) & (step < 0)) |
+                ((popt[rows] >= upper[rows]) & (step > 0)))
+        if held.any():
+            free = ~held
+            damped = (damped * (free[:, :, None] & free[:, None, :]) +
+                    held[:, :, None] * np.eye(4))
+            step = lm_steps(damped, g * free)
+        trial = np.clip(popt[rows] + step, lower[rows], upper[rows])
+        # whole batch without gathering rows while nothing has converged
+        trial_res = model.residual(trial, vol, rows if len(rows) < n else None)
+        nfev[rows] += 1
+        trial_ssr = (trial_res**2).sum(axis = 1)
+        better = np.isfinite(trial_ssr) & (trial_ssr < ssr[rows])
+        moved = np.abs(trial - popt[rows])
+        small_step = np.all(moved <= xtol * (np.abs(popt[rows]) + xtol), axis = 1)
+        small_gain = better & (ssr[rows] - trial_ssr <= ftol * ssr[rows])
+        # accepted steps: move and trust the quadratic model more
+        acc = rows[better]
+        popt[acc] = trial[better]
+        res[acc] = trial_res[better]
+        ssr[acc] = trial_ssr[better]
+        lam[acc] = np.maximum(lam[acc] / 10, 1e-12)
+        lam[rows[~better]] *= 10
+        done = small_step | small_gain | (lam[rows] > 1e16)
+        active[rows[done]] = False
+        refresh = acc[active[acc]]
+        if len(refresh):
+            jac[refresh] = model.jacobian(popt[refresh], refresh)
+    # covariance as in curve_fit: pinv(J^T J) scaled by the reduced chi2
+    chi2 = ssr / dof
+    jac = model.jacobian(popt)
+    pcov = np.linalg.pinv(np.matmul(jac.transpose(0, 2, 1), jac)) * chi2[:, None, None]
+    return popt, pcov, chi2, nfev
+
+# resampled fits per scan for parameter uncertainties
+resample_count = 100
+
+# spread of the fitted parameters p0 (n, 4) of many scans, from refitting
+# resampled scans all at once: 'bootstrap' refits the fit plus residuals
+# drawn with replacement (samples times per scan), 'jackknife' refits with
+# each point left out in turn. Draws are seeded by the scan's data, so they
+# don't depend on how scans are batched. Returns the mean and standard
+# deviation (n, 4) of the resampled parameters
+def resample_fit(positions, voltages, p0, method = 'bootstrap', samples = None,
+        constraints = None, width = None, seed = 0):
+    if samples is None:
+        samples = resample_count
+    pos, vol, mask, index_array = pad_scans(positions, voltages, width)
+    n, width = pos.shape
+    if method == 'jackknife':
+        samples = width
+    elif method != 'bootstrap':
+        raise ValueError("Unknown resampling method {}".format(method))
+    popt = np.array(p0, dtype = float).reshape(n, 4)
+    lengths = mask.sum(axis = 1)
+    fitted = RsoModel(pos, index_array, mask).evaluate(popt).copy()
+    # residuals scaled up for the 4 fitted parameters
+    resid = (vol - fitted) * mask * np.sqrt(lengths / (lengths - 4.))[:, None]
+    mean = np.empty((n, 4))
+    sigma = np.empty((n, 4))
+    chunk = max(1, 2**21 // (samples * width))
+    for start in range(0, n, chunk):
+        scans = np.arange(start, min(start + chunk, n))
+        rows = np.repeat(scans, samples)
+        sample_mask = mask[rows]
+        if method == 'bootstrap':
+            draws = np.concatenate([np.random.default_rng([seed,
+                zlib.crc32(vol[i, :lengths[i]].tobytes())]).random((samples, width))
+                for i in scans])
+            draws = (draws * lengths[rows][:, None]).astype(int)
+            sample_vol = fitted[rows] + np.take_along_axis(resid[rows], draws, axis = 1)
+        else:
+            sample_vol = vol[rows]
+            sample_mask[np.arange(len(rows)), np.tile(np.arange(width), len(scans))] = False
+        p, pcov, chi2, nfev = padded_curve_fit(pos[rows], sample_vol, sample_mask,
+                index_array[rows], popt[rows], constraints)
+        p = p.reshape(len(scans), samples, 4)
+        if method == 'bootstrap':
+            mean[scans] = p.mean(axis = 1)
+            sigma[scans] = p.std(axis = 1, ddof = 1)
+        else:
+            # only samples that left out one of the scan's points
+            kept = mask[scans][:, :, None]
+            m = lengths[scans][:, None]
+            mean[scans] = (p * kept).sum(axis = 1) / m
+            spread = (((p - mean[scans][:, None]) * kept)**2).sum(axis = 1)
+            sigma[scans] = np.sqrt(spread * (m - 1) / m)
+    return mean, sigma
+
+# batched version of the multistart center search of fit(center = True),
+# without skipping or stopping early: returns the best fit over all
+# starting centers for every scan, with nfev summed over the starts
+def batch_center_fit(positions, voltages, constraints = None, centers = None, width = None):
+    if centers is None:
+        centers = np.unique(multistart_centers)
+    n, nc = len(positions), len(centers)
+    p0 = np.zeros((n, nc, 4))
+    p0[:, :, 2] = np.array([(max(v) - min(v))/2.65 for v in voltages])[:, None]
+    p0[:, :, 3] = -np.asarray(centers)
+    rep = lambda l : [x for x in l for c in centers]
+    popt, pcov, chi2, nfev = batch_curve_fit(rep(positions), rep(voltages),
+            p0.reshape(-1, 4), constraints = constraints, width = width)
+    chi2 = np.where(np.isfinite(chi2), chi2, np.inf).reshape(n, nc)
+    best = np.argmin(chi2, axis = 1)
+    rows = np.arange(n) * nc + best
+    return popt[rows], pcov[rows], chi2[np.arange(n), best], nfev.reshape(n, nc).sum(axis = 1)
+
+# separable (variable projection) center search. rso_response is linear in
+# x1, x2 and x3, so for every trial center they are solved in closed form by a
+# batched 3x3 least squares solve. Returns the best (n_scans, 4) parameters on
+# the center grid, respecting the constraints. centers are the same for
+# every scan (k,) or given per scan (n_scans, k)
+def varpro_starts(positions, voltages, constraints = None, centers = None, width = None):
+    if centers is None:
+        centers = varpro_centers
+    if constraints is None:
+        constraints = FitConstraints()
+    x4 = -np.asarray(centers, dtype = float)
+    lower, upper = constraints.bounds()
+    if x4.ndim == 1:
+        x4_ok = (x4 >= lower[3]) & (x4 <= upper[3])
+        if x4_ok.any():
+            x4 = x4[x4_ok]
+        x4 = np.broadcast_to(x4, (len(positions), len(x4)))
+    pos, vol, mask, index_array = pad_scans(positions, voltages, width)
+    vol = np.where(mask, vol, 0)
+    t = np.where(mask, index_array, 0)
+    R = rso_R
+    L = rso_L
+    starts = np.empty((len(positions), 4))
+    # keep the (scans, centers, points) temporaries to a few million elements
+    chunk = max(1, 2**22 // (x4.shape[1] * pos.shape[1]))
+    for c in range(0, len(positions), chunk):
+        rows = slice(c, c + chunk)
+        u = pos[rows, None, :] + x4[rows, :, None]
+        X = R**2 + u**2
+        Y = R**2 + (L + u)**2
+        Z = R**2 + (-L + u)**2
+        g = (2 * X**(-3/2) - Y**(-3/2) - Z**(-3/2)) * mask[rows, None, :]
+        k, nc = g.shape[:2]
+        # normal equations for (x1, x2, x3) at every center
+        A = np.empty((k, nc, 3, 3))
+        A[:, :, 0, 0] = mask[rows].sum(axis = 1)[:, None]
+        A[:, :, 0, 1] = A[:, :, 1, 0] = t[rows].sum(axis = 1)[:, None]
+        A[:, :, 1, 1] = (t[rows]**2).sum(axis = 1)[:, None]
+        A[:, :, 0, 2] = A[:, :, 2, 0] = g.sum(axis = 2)
+        A[:, :, 1, 2] = A[:, :, 2, 1] = np.einsum('kcm,km->kc', g, t[rows])
+        A[:, :, 2, 2] = np.einsum('kcm,kcm->kc', g, g)
+        b = np.empty((k, nc, 3))
+        b[:, :, 0] = vol[rows].sum(axis = 1)[:, None]
+        b[:, :, 1] = (t[rows] * vol[rows]).sum(axis = 1)[:, None]
+        b[:, :, 2] = np.einsum('kcm,km->kc', g, vol[rows])
+        lin = np.linalg.solve(A + 1e-300 * np.eye(3), b[..., None])[..., 0]
+        # residual sum of squares of the linear least squares solution
+        ssr = (vol[rows]**2).sum(axis = 1)[:, None] - (lin * b).sum(axis = 2)
+        ok = np.all((lin >= lower[:3]) & (lin <= upper[:3]), axis = 2)
+        ssr = np.where(np.isfinite(ssr), ssr, np.inf)
+        best = np.argmin(np.where(ok, ssr, np.inf), axis = 1)
+        # nothing feasible: fall back to the unconstrained best center
+        free = ~ok.any(axis = 1)
+        best[free] = np.argmin(ssr[free], axis = 1)
+        starts[rows, :3] = lin[np.arange(k), best]
+        starts[rows, 3] = x4[rows][np.arange(k), best]
+    return starts
+
+# rough SQUID's fits of many scans from its fitted voltages, without
+# iterating: the response peaks where the scan passes the sample, so the
+# center is looked for within a point of the largest |fit_voltage| and the
+# rest solved as in varpro_starts. Returns (n_scans, 4) parameters
+def squid_fit_estimates(positions, fit_voltages, width = None):
+    pos, vol, mask, index_array = pad_scans(positions, fit_voltages, width)
+    peak = np.argmax(np.abs(vol) * mask, axis = 1)
+    step = np.abs(pos[:, 1] - pos[:, 0]) if pos.shape[1] > 1 else np.zeros(len(pos))
+    centers = (pos[np.arange(len(pos)), peak][:, None] +
+            step[:, None] * np.linspace(-1, 1, 9)[None, :])
+    return varpro_starts(positions, fit_voltages, centers = centers, width = width)
+
+# center search for many scans: separable grid search, then one batched
+# nonlinear fit polishing the best center of every scan
+def varpro_center_fit(positions, voltages, constraints = None, width = None):
+    p0 = varpro_starts(positions, voltages, constraints, width = width)
+    return batch_curve_fit(positions, voltages, p0, constraints, width = width)
+
+# on-disk fit results of the scans of one data file, one .npz record per
+# block_size rows holding every field stacked over the block's entries.
+# Entries are found by a hash of the scan's raw arrays, the fitting limits
+# and settings, the model constants and the starting fit p0, so an edited
+# scan or a changed limit only misses the entries it affects. A record keeps
+# its last max_entries entries
+class Fit_cache:
+    fields = ['best_popt', 'best_pcov', 'best_chi2',
+            'squid_popt', 'squid_pcov', 'squid_fit_chi2', 'squid_chi2']
+    block_size = 1024
+    max_entries = 4 * block_size
+
+    def __init__(self, fname, directory = None, max_bytes = None):
+        self.directory = fit_cache_dir if directory is None else directory
+        self.max_bytes = fit_cache_max_bytes if max_bytes is None else max_bytes
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+        self.source = hashlib.sha1(os.path.abspath(fname).encode()).hexdigest()
+        # records read so far, block -> (keys, dict of key -> index, fields)
+        self.records = {}
+        # bytes written since the last eviction; the first store evicts
+        self.unevicted = self.max_bytes
+
+    def key(self, scan, constraints, p0 = None, **settings):
+        settings.update(fit_settings())
+        settings.update(constraints = constraints.key(), p0 = None if p0 is None
+                else np.asarray(p0, dtype = float), version = fit_cache_version,
+                R = rso_R, L = rso_L)
+        h = hashlib.sha1()
+        for name in sorted(settings):
+            value = settings[name]
+            if isinstance(value, np.ndarray):
+                value = value.tobytes()
+            h.update(repr((name, value)).encode())
+        for a in (scan.position, scan.voltage, scan.fit_voltage):
+            h.update(np.ascontiguousarray(a, dtype = float).tobytes())
+        return h.hexdigest()
+
+    def path(self, block):
+        return os.path.join(self.directory, '{}_{}.npz'.format(self.source, block))
+
+    def record(self, block):
+        if block not in self.records:
+            try:
+                with np.load(self.path(block)) as entry:
+                    keys = list(entry['keys'])
+                    fields = dict((name, entry[name]) for name in self.fields)
+                # mark as recently used for eviction
+                os.utime(self.path(block), None)
+            except (IOError, OSError, KeyError, ValueError):
+                keys, fields = [], None
+            self.records[block] = (keys, dict((k, i) for i, k in enumerate(keys)), fields)
+        return self.records[block]
+
+    # cached results of the scan at row under key, None if there are none
+    def load(self, row, key):
+        keys, index, fields = self.record(row // self.block_size)
+        i = index.get(key)
+        if i is None:
+            return None
+        return dict((name, fields[name][i]) for name in self.fields)
+
+    # add the results (dicts of fields) of the scans at rows under keys,
+    # rewriting the records of their blocks
+    def store(self, rows, keys, results):
+        blocks = np.asarray(rows) // self.block_size
+        for block in np.unique(blocks):
+            new = [(k, r) for b, k, r in zip(blocks, keys, results) if b == block]
+            new_keys = set(k for k, r in new)
+            old_keys, index, fields = self.record(block)
+            old = [k for k in old_keys if k not in new_keys]
+            old = old[max(len(old) + len(new) - self.max_entries, 0):]
+            merged = {}
+            for name in self.fields:
+                values = [fields[name][index[k]] for k in old]
+                merged[name] = np.array(values + [r[name] for k, r in new], dtype = float)
+            merged_keys = old + [k for k, r in new]
+            # write to a temporary file first so readers never see half a record
+            path = self.path(block)
+            tmp = path + '.{}.tmp'.format(os.getpid())
+            with open(tmp, 'wb') as f:
+                np.savez(f, keys = np.array(merged_keys), **merged)
+            os.replace(tmp, path)
+            self.records[block] = (merged_keys,
+                    dict((k, i) for i, k in enumerate(merged_keys)), merged)
+            self.unevicted += os.path.getsize(path)
+        # evict once every max_bytes / 16 written, not on every store
+        if self.unevicted >= self.max_bytes // 16:
+            self.evict()
+            self.unevicted = 0
+
+    # remove least recently used entries until the cache fits in max_bytes
+    def evict(self):
+        entries = []
+        for name in os.listdir(self.directory):
+            if not name.endswith('.npz'):
+                continue
+            try:
+                st = os.stat(os.path.join(self.directory, name))
+            except OSError:
+                continue
+            entries.append((st.st_mtime, st.st_size, name))
+        total = sum(e[1] for e in entries)
+        for mtime, size, name in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(os.path.join(self.directory, name))
+            except OSError:
+                pass
+            total -= size
+
+# batched center fit selected by center_search
+def center_fit_function():
+    return varpro_center_fit if center_search == 'varpro' else batch_center_fit
+
+# module settings that change fitting results, shipped to worker processes
+def fit_settings():
+    names = ['center_search', 'varpro_centers', 'multistart_centers',
+            'multistart_center_tol', 'multistart_patience', 'model_backend']
+    return dict((name, globals()[name]) for name in names)
+
+# how worker processes are started. Forking a process with running threads
+# (Tk, the prefetcher) can leave its locks held in the child, so workers are
+# started afresh; 'forkserver' starts faster where it is available (not on
+# Windows)
+pool_start_method = 'spawn'
+
+def process_pool(jobs):
+    return ProcessPoolExecutor(max_workers = jobs,
+            mp_context = multiprocessing.get_context(pool_start_method))
+
+# process pools are shared between Squid objects, one per number of workers
+_executors = {}
+def fit_executor(jobs):
+    if jobs not in _executors:
+        _executors[jobs] = process_pool(jobs)
+    return _executors[jobs]
+
+# runs in a worker process: fit a chunk of scans with the parent's settings
+def _batch_fit_worker(func, positions, voltages, width, settings, kwargs):
+    globals().update(settings)
+    return func(positions, voltages, width = width, **kwargs)
+
+def load_file(fname = None, dep = 'temperature', jobs = 1, warm_start = True, cache = True,
+        follow = False, profile = False, lazy = False):
     if fname is None:
+        import_tk()
         fname = filedialog.askopenfilename()
     if fname is None:
         return
-    sqd_data = Squid(fname, dep)
+    sqd_data = Squid(fname, dep, jobs = jobs, warm_start = warm_start, cache = cache,
+            follow = follow, profile = profile, lazy = lazy)
     # sqd_data.plot_dependence()
     return sqd_data
 
 def dump_fit(squid, fname = None):
     if fname is None:
+        import_tk()
         fname = filedialog.asksaveasfile(mode = 'w', defaultextension = '.csv',
                 filetypes = [('Comma separated values', '.csv'), ('All files', '.*')])
     if fname is None:
         return
+    squid.ensure_fitted()
     columnnames = ['Scan index', 'Time (s)', 'Field (Oe)', 'Temperature (K)',
             'Long Moment fitted (EMU)', 'Long Moment Original (EMU)',
-            'Delta T (K)', 'Reduced chi2 fitted', 'Reduced chi2 original']
+            'Delta T (K)', 'Reduced chi2 fitted', 'Reduced chi2 original',
+            'Long Moment fitted sigma (EMU)']
     fname.write(','.join(columnnames) + '\n')
     for i, s in enumerate(squid.scans):
         data = [i, s.time, s.field, s.temperature, s.get_best_moment(),
-                s.get_squid_moment(), s.delta_temp, s.best_chi2, s.squid_chi2]
+                s.get_squid_moment(), s.delta_temp, s.best_chi2, s.squid_chi2,
+                s.get_best_moment_sigma()]
         fname.write(','.join([str(d) for d in data]) + '\n')
     fname.close()
 
+# fit results saved by export_fits for every scan, with their shape per scan
+fit_columns = [('time', ()), ('field', ()), ('temperature', ()), ('delta_temp', ()),
+        ('best_popt', (4,)), ('best_pcov', (4, 4)), ('best_chi2', ()), ('best_sigma', (4,)),
+        ('squid_popt', (4,)), ('squid_pcov', (4, 4)), ('squid_chi2', ()),
+        ('squid_fit_chi2', ())]
+
+# fit results of all scans as arrays, one per fit_columns entry with the
+# scans along the first axis (nan for missing fits)
+def fit_arrays(squid):
+    squid.ensure_fitted()
+    arrays = {'scan_index':np.arange(len(squid.scans))}
+    rows = squid.rows(squid.scans)
+    for name, shape in fit_columns:
+        arrays[name] = getattr(squid.table, name)[rows].reshape((len(rows),) + shape)
+    stale = ~np.all(squid.table.sigma_popt[rows] == squid.table.best_popt[rows], axis = 1)
+    arrays['best_sigma'][stale] = np.nan
+    return arrays
+
+# write fit_arrays to fname without a dialog, as .npz, or as HDF5 (.h5,
+# .hdf5, needs h5py) or Parquet (.parquet, needs pandas with pyarrow or
+# fastparquet) by extension; Parquet gets one column per element, e.g.
+# best_pcov_2_3
+def export_fits(squid, fname):
+    arrays = fit_arrays(squid)
+    ext = os.path.splitext(fname)[1].lower()
+    if ext in ('.h5', '.hdf5'):
+        import h5py
+        with h5py.File(fname, 'w') as f:
+            for name, array in arrays.items():
+                f.create_dataset(name, data = array)
+            f.attrs['source'] = squid.fname
+    elif ext == '.parquet':
+        import pandas
+        columns = {}
+        for name, array in arrays.items():
+            for index in np.ndindex(array.shape[1:]):
+                column = '_'.join([name] + [str(i) for i in index])
+                columns[column] = array[(slice(None),) + index]
+        frame = pandas.DataFrame(columns)
+        frame.attrs['source'] = squid.fname
+        frame.to_parquet(fname)
+    elif ext == '.npz':
+        np.savez(fname, source = squid.fname, **arrays)
+    else:
+        raise ValueError('Unknown fit export format {}, use .npz, .h5 or .parquet'.format(ext))
+
+# read fits written by export_fits back into the arrays of fit_arrays,
+# plus 'source', the raw data file they came from
+def load_fits(fname):
+    ext = os.path.splitext(fname)[1].lower()
+    if ext in ('.h5', '.hdf5'):
+        import h5py
+        with h5py.File(fname, 'r') as f:
+            arrays = dict((name, f[name][()]) for name in f)
+            arrays['source'] = f.attrs['source']
+    elif ext == '.parquet':
+        import pandas
+        frame = pandas.read_parquet(fname)
+        arrays = {'scan_index':frame['scan_index'].to_numpy(),
+                'source':frame.attrs.get('source')}
+        for name, shape in fit_columns:
+            columns = ['_'.join([name] + [str(i) for i in index])
+                    for index in np.ndindex(shape)]
+            arrays[name] = frame[columns].to_numpy().reshape((len(frame),) + shape)
+    else:
+        with np.load(fname) as f:
+            arrays = dict((name, f[name]) for name in f.files)
+        arrays['source'] = str(arrays['source'])
+    return arrays
+
+# runs in a worker process: load and fit one file without plots and write
+# its dump_fit csv and export_fits npz into output, returns the number of
+# scans
+def _batch_file_worker(fname, output, dep, warm_start, cache, settings,
+        uncertainties = None, stats = False, profile = False):
+    globals().update(settings)
+    squid = Squid(fname, dep, warm_start = warm_start, cache = cache, plots = False,
+            profile = profile)
+    if uncertainties:
+        squid.fit_uncertainties(uncertainties)
+    name = os.path.splitext(os.path.basename(fname))[0] + '_fit'
+    dump_fit(squid, open(os.path.join(output, name + '.csv'), 'w'))
+    export_fits(squid, os.path.join(output, name + '.npz'))
+    save_stats(squid, output, stats, profile)
+    return len(squid.scans)
+
+# write the stats of squid to <output>/<name>_stats.json and, if it is
+# being profiled, its profile to <output>/<name>.prof
+def save_stats(squid, output = '.', stats = True, profile = False):
+    name = os.path.join(output, os.path.splitext(os.path.basename(squid.fname))[0])
+    if profile:
+        squid.stats.stop_profile(name + '.prof')
+    if stats:
+        squid.dump_stats(name + '_stats.json')
+
+# fit files in a pool of jobs worker processes, one file per worker,
+# writing <name>_fit.csv and <name>_fit.npz for each into output
+# uncertainties ('bootstrap' or 'jackknife') also works out moment sigmas
+# stats and profile also write each file's stats and profile (see save_stats)
+def batch(fnames, output = '.', jobs = 1, dep = 'temperature', warm_start = True,
+        cache = True, uncertainties = None, stats = False, profile = False):
+    start_time = time.time()
+    if not os.path.isdir(output):
+        os.makedirs(output)
+    settings = fit_settings()
+    settings.update(fit_cache_dir = fit_cache_dir, sqd_sidecar = sqd_sidecar)
+    n_scans, n_files, failed = 0, 0, []
+    with process_pool(max(jobs, 1)) as executor:
+        futures = dict((executor.submit(_batch_file_worker, f, output, dep, warm_start,
+            cache, settings, uncertainties, stats, profile), f) for f in fnames)
+        for future in as_completed(futures):
+            fname = futures[future]
+            try:
+                scans = future.result()
+            except Exception as e:
+                print("Failed {}: {}".format(fname, e))
+                failed.append(fname)
+                continue
+            n_scans += scans
+            n_files += 1
+            print("Fitted {} scans of {}".format(scans, fname))
+    elapsed = time.time() - start_time
+    print("\n{} files, {} scans in {:.2f} s: {:.1f} scans/s, {:.2f} files/s".format(
+        n_files, n_scans, elapsed, n_scans / elapsed, n_files / elapsed))
+    if failed:
+        print("{} files failed: {}".format(len(failed), ', '.join(failed)))
+    return failed
+
 def main(args):
-    window = Window()
-    time.sleep(1)
     dep = {0:'temperature', 1:'field'}[args.dependence]
+    global fit_cache_dir, sqd_sidecar
+    if args.cache_dir is not None:
+        fit_cache_dir = args.cache_dir
+    sqd_sidecar = not args.no_sidecar
+    warm_start = not args.no_warm_start
+    cache = not args.no_cache
+    if args.batch:
+        if not args.FILE:
+            print("--batch needs input files")
+            return 1
+        return 1 if batch(args.FILE, args.output, args.jobs, dep, warm_start, cache,
+                args.uncertainties, args.stats, args.profile) else 0
+    window = Window()
+    if not window.wait_ready():
+        print("Could not open the window")
+        return 1
     if args.FILE is None or args.FILE == []:
-        sqd_data = [load_file(dep = dep)]
+        sqd_data = [load_file(dep = dep, jobs = args.jobs, warm_start = warm_start, cache = cache,
+            follow = args.follow, profile = args.profile, lazy = args.lazy)]
     else:
-        sqd_data = [load_file(f, dep) for f in args.FILE]
+        sqd_data = [load_file(f, dep, args.jobs, warm_start, cache, args.follow, args.profile,
+            args.lazy) for f in args.FILE]
     s = sqd_data[0]
+    if args.follow:
+        for squid in sqd_data:
+            squid.follow(args.follow_interval)
     window.load_squid(s)
     plt.ion()
-    time.sleep(1)
     plt.show()
-    time.sleep(1)
+    from IPython import embed
     embed(display_banner = False)
+    if args.stats or args.profile:
+        for squid in sqd_data:
+            save_stats(squid, args.output, args.stats, args.profile)
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
@@ -1193,5 +3339,31 @@ if __name__ == '__main__':
             help = "Raw squid data files")
     parser.add_argument("--dependence", action = "store_true",
             help = "Changes magnetic moment dependence to Field if specified (default to temperature)")
+    parser.add_argument("--jobs", type = int, default = 1,
+            help = "Number of worker processes used for fitting (default 1, no workers)")
+    parser.add_argument("--no-warm-start", action = "store_true",
+            help = "Fit every scan independently instead of starting from the previous scan's fit")
+    parser.add_argument("--no-cache", action = "store_true",
+            help = "Always refit scans instead of reusing fits from earlier loads")
+    parser.add_argument("--cache-dir", default = None,
+            help = "Directory of the fit cache (default {})".format(fit_cache_dir))
+    parser.add_argument("--no-sidecar", action = "store_true",
+            help = "Always parse raw files instead of using their .npy copies")
+    parser.add_argument("--lazy", action = "store_true",
+            help = "Open files before fitting them, fitting scans when needed and in the background")
+    parser.add_argument("--follow", action = "store_true",
+            help = "Keep reading the files as they are written, fitting new scans as they finish")
+    parser.add_argument("--follow-interval", type = float, default = 2,
+            help = "Seconds between checks for new scans with --follow (default 2)")
+    parser.add_argument("--batch", action = "store_true",
+            help = "Fit the files without display, --jobs at a time, and write their fits to --output")
+    parser.add_argument("--output", default = '.',
+            help = "Directory for the <file>_fit.csv and .npz files written by --batch (default .)")
+    parser.add_argument("--stats", action = "store_true",
+            help = "Write stage timings and fit counts of each file to <file>_stats.json in --output")
+    parser.add_argument("--profile", action = "store_true",
+            help = "Profile each file (until exit, without --batch), written to <file>.prof in --output")
+    parser.add_argument("--uncertainties", choices = ['bootstrap', 'jackknife'], default = None,
+            help = "With --batch, also work out moment uncertainties by resampling")
     args = parser.parse_args()
-    main(args)
+    sys.exit(main(args))